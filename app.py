@@ -1,16 +1,61 @@
+import asyncio
+import json
+import os
+import time
 import uvicorn
 import shutil
+import threading
+import numpy as np
+import torch
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from fastapi import FastAPI, File, UploadFile, Form
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, PlainTextResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-from recognize import predict_file, predict_file_async, init
+from recognize import init, is_ready, load_segments, iter_load_segments, predict_batch, segment_record, registry, \
+    startup_timings, audio_formats, transcription_cache, decoder_settings, lm_cache
+import metrics
+import profiling
+import recognize
+from cache import file_digest, settings_key
+from scheduler import Scheduler, QueueFullError
+from split import StreamingSegmenter, MAX_LENGTH
 
 app = FastAPI()
 
+# segments of concurrent requests are batched together on one inference worker
+scheduler = Scheduler(predict_batch, max_batch_size=16, max_wait=0.05, max_queue=32, retry_after=10,
+                      max_segments=1024)
+
+# uploads, audio decoding, segmentation and response encoding run on a small thread pool,
+# the cores left over are used by torch on the inference worker
+cpu_count = os.cpu_count() or 1
+io_workers = max(1, min(4, cpu_count // 4))
+torch_threads = max(1, cpu_count - io_workers)
+
+executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="io-worker")
+
+metrics.Gauge("asr_queue_depth", "Segments waiting for inference", function=lambda: scheduler.queue.qsize())
+metrics.Gauge("asr_active_requests", "Requests holding a scheduler slot", function=lambda: scheduler.active)
+metrics.Gauge("asr_loaded_models", "Acoustic models in memory", function=lambda: len(registry.loaded()))
+metrics.Gauge("asr_lm_cache_entries", "Sentences in the lm score cache", function=lambda: len(lm_cache))
+
+# live captions: an utterance is final after live_pause samples of silence, the open utterance
+# is transcribed as a partial hypothesis every live_partial_interval samples
+live_pause = 8_000
+live_partial_interval = 16_000
+
+# silence is live_top_db below the loudest frame so far, the level split_long_runs splits long runs at,
+# 50 dB (as for files) misses the pauses of recordings with a noise floor and utterances never end
+live_top_db = 30
+
+# segments of one /transcribe_async request queued for inference at a time, so segmentation
+# stays a batch ahead of inference instead of holding the audio of the whole file
+stream_ahead = 16
+
 origins = [
     "http://localhost",
     "http://localhost:8080",
@@ -28,38 +73,314 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+def start_scheduler():
+    torch.set_num_threads(torch_threads)
+    scheduler.start()
+
+    # the port opens right away, the models load in the background and the lm on first use
+    threading.Thread(target=init, kwargs={"with_lm": False}, name="model-loader", daemon=True).start()
+
+
+def check_model(model_id):
+    if model_id not in registry:
+        raise HTTPException(status_code=404, detail=f"Unknown model: {model_id}")
+
+
+def check_audio_format(audio_format):
+    if audio_format not in audio_formats:
+        raise HTTPException(status_code=400, detail=f"Unknown audio format: {audio_format}, "
+                                                    f"use one of {', '.join(audio_formats)}")
+
+
+async def run_blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+def segment_records(segments, labels, audio_format):
+    return [segment_record(start, end, seg, label, audio_format) for (start, end, seg), label in zip(segments, labels)]
+
+
+@app.exception_handler(QueueFullError)
+def queue_full(request, exc: QueueFullError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)},
+                        headers={"Retry-After": str(exc.retry_after)})
+
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
 
 
+# liveness
 @app.post("/ping")
-def ping():
+async def ping():
     return True
 
 
+# readiness, the default model has been loaded (and stays ready when the registry unloads it later)
+@app.get("/ready")
+async def ready():
+    if not is_ready():
+        content = {"ready": False}
+
+        # a failed model load is reported until a later init succeeds
+        if recognize.init_error is not None:
+            content["error"] = repr(recognize.init_error)
+
+        return JSONResponse(status_code=503, content=content)
+
+    return {"ready": True, "timings": startup_timings}
+
+
+# segments per decoding path
+@app.get("/stats")
+async def stats():
+    return {"decode": {path: count for (path,), count in metrics.decoded_segments.collect().items()}}
+
+
+# share of requests that are profiled, can be changed while running
+@app.get("/profiling")
+async def get_profiling():
+    return {"sample_rate": profiling.sample_rate}
+
+
+@app.put("/profiling")
+async def put_profiling(sample_rate: float):
+    profiling.set_sample_rate(sample_rate)
+
+    return {"sample_rate": profiling.sample_rate}
+
+
+# prometheus text format
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/transcribe/{model_id}")
-async def transcribe(model_id: str = '1', file: UploadFile = File(...)):
+async def transcribe(model_id: str = '1', file: UploadFile = File(...), audio_format: str = 'wav',
+                     profile: bool = False):
     now = datetime.now()
     dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
     print(dt_string, "transcribe()")
 
-    suffix = Path(file.filename).suffix
-    with NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        shutil.copyfileobj(file.file, tmp)
-        tmp_path = Path(tmp.name)
+    check_model(model_id)
+    check_audio_format(audio_format)
 
-        result = await predict_file(tmp_path)
+    with scheduler.slot():
+        tmp_path = await run_blocking(save_upload_file_tmp, file)
+        key = settings_key(await run_blocking(file_digest, tmp_path), decoder_settings(model_id, audio_format))
 
-        return result
+        # repeated uploads are answered from the cache, identical uploads in flight share one transcription
+        async def compute():
+            segments = await run_blocking(load_segments, tmp_path)
+            labels = await scheduler.transcribe([seg for _, _, seg in segments], model_id)
+
+            return await run_blocking(segment_records, segments, labels, audio_format)
+
+        # ?profile=true (or sampling) writes a trace of this request
+        async with profiling.profiled_async(file.filename or "upload", profiling.should_profile(profile), executor):
+            return await transcription_cache.get_or_compute(key, compute)
 
 
 @app.post("/transcribe_async/{model_id}")
-def transcribe_async(model_id: str = '1', file: UploadFile = File(...)):
+async def transcribe_async(model_id: str = '1', file: UploadFile = File(...), audio_format: str = 'wav'):
     print("transcribe_async()")
 
-    tmp_path = save_upload_file_tmp(file)
-    return StreamingResponse(predict_file_async(tmp_path), media_type='text/plain')
+    check_model(model_id)
+    check_audio_format(audio_format)
+
+    # reserve a slot before streaming, so a full queue can still answer with 503
+    scheduler.acquire()
+
+    try:
+        tmp_path = await run_blocking(save_upload_file_tmp, file)
+    except:
+        scheduler.release()
+        raise
+
+    try:
+        # the streaming segmenter cuts differently than load_segments, so /transcribe has its own entries
+        key = settings_key(await run_blocking(file_digest, tmp_path),
+                           decoder_settings(model_id, audio_format, streaming=True))
+        records = await run_blocking(transcription_cache.get, key)
+    except:
+        scheduler.release()
+        raise
+
+    if records is not None:
+        scheduler.release()
+
+        return StreamingResponse((json.dumps(record) + "\n" for record in records), media_type='application/x-ndjson')
+
+    return StreamingResponse(stream_transcription(tmp_path, model_id, audio_format, key),
+                             media_type='application/x-ndjson')
+
+
+# newline-delimited json, a segment is queued for inference as soon as it is cut and
+# written out as soon as it and all segments before it are transcribed
+async def stream_transcription(tmp_path, model_id, audio_format, key=None):
+    pending = asyncio.Queue()
+    ahead = asyncio.Semaphore(stream_ahead)
+    records = []
+    producer = asyncio.create_task(queue_segments(tmp_path, model_id, pending, ahead))
+
+    try:
+        while True:
+            item = await pending.get()
+
+            if item is None:
+                break
+
+            start, end, seg, future, timings = item
+
+            start_time = time.perf_counter()
+            label = await asyncio.wrap_future(future)
+            timings["inference"] = time.perf_counter() - start_time
+            ahead.release()
+
+            start_time = time.perf_counter()
+            record = await run_blocking(segment_record, start, end, seg, label, audio_format)
+            timings["encode"] = time.perf_counter() - start_time
+
+            records.append(record)
+            yield json.dumps({**record, "timings": timings}) + "\n"
+
+        # reraise segmentation errors
+        await producer
+
+        # completed transcriptions are cached like those of /transcribe
+        if key is not None:
+            await run_blocking(transcription_cache.put, key, records)
+    finally:
+        producer.cancel()
+
+        # segments of disconnected clients are dropped
+        cancel_queued(pending)
+        scheduler.release()
+
+
+async def queue_segments(tmp_path, model_id, pending, ahead):
+    segments = iter_load_segments(tmp_path)
+
+    try:
+        while True:
+            # segmentation waits until fewer than stream_ahead segments are queued for inference
+            await ahead.acquire()
+
+            start_time = time.perf_counter()
+            item = await run_blocking(next, segments, None)
+            segment_time = time.perf_counter() - start_time
+            metrics.stage_seconds.observe(segment_time, stage="stream_segment")
+
+            if item is None:
+                break
+
+            start, end, seg = item
+
+            # later segments of long recordings queue behind short requests
+            future = scheduler.submit([seg], model_id, priority=end)[0]
+            pending.put_nowait((start, end, seg, future, {"segment": segment_time}))
+    finally:
+        pending.put_nowait(None)
+
+
+# cancels the scheduler futures of queued (..., future, ...) items, the inference worker skips them
+def cancel_queued(queue):
+    while not queue.empty():
+        item = queue.get_nowait()
+
+        if item is not None:
+            item[3].cancel()
+
+
+# live captions, the client sends 16 kHz mono pcm as binary messages (16-bit little-endian samples,
+# or float32 with ?encoding=float32) and a text message to finish, the server answers with
+# {"type": "partial" | "final", "start", "end", "label"} messages
+@app.websocket("/live/{model_id}")
+async def live(websocket: WebSocket, model_id: str = '1', encoding: str = 'pcm16'):
+    await websocket.accept()
+
+    if model_id not in registry or encoding not in ("pcm16", "float32"):
+        await websocket.close(code=1008)
+        return
+
+    try:
+        scheduler.acquire()
+    except QueueFullError:
+        await websocket.close(code=1013)
+        return
+
+    segmenter = StreamingSegmenter(top_db=live_top_db, lookahead=MAX_LENGTH, close_after=live_pause,
+                                   max_run_length=MAX_LENGTH)
+    outgoing = asyncio.Queue()
+    sender = asyncio.create_task(send_captions(websocket, outgoing))
+
+    partial = None
+    since_partial = 0
+
+    try:
+        while True:
+            message = await websocket.receive()
+
+            if message["type"] == "websocket.disconnect" or message.get("bytes") is None:
+                break
+
+            if encoding == "pcm16":
+                block = np.frombuffer(message["bytes"], dtype="<i2").astype(np.float32) / 32768
+            else:
+                block = np.frombuffer(message["bytes"], dtype="<f4")
+
+            for start, end, seg in await run_blocking(segmenter.push, block):
+                await queue_caption(outgoing, "final", start, end, seg, model_id)
+
+            since_partial += len(block)
+
+            # skip partials while the previous one is still being transcribed
+            if since_partial >= live_partial_interval and (partial is None or partial.done()):
+                since_partial = 0
+                pending = segmenter.pending()
+
+                if pending is not None:
+                    partial = await queue_caption(outgoing, "partial", *pending, model_id)
+
+        for start, end, seg in await run_blocking(segmenter.flush):
+            await queue_caption(outgoing, "final", start, end, seg, model_id)
+
+        await outgoing.put(None)
+        await sender
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # cancelling the sender also cancels the caption it waits for
+        sender.cancel()
+        cancel_queued(outgoing)
+        scheduler.release()
+
+
+async def queue_caption(outgoing, caption_type, start, end, seg, model_id):
+    if end - start < 2_048:
+        return None
+
+    future = scheduler.submit([seg], model_id)[0]
+    await outgoing.put((caption_type, int(start), int(end), future))
+
+    return future
+
+
+async def send_captions(websocket, outgoing):
+    while True:
+        item = await outgoing.get()
+
+        if item is None:
+            await websocket.close()
+            break
+
+        caption_type, start, end, future = item
+        label = await asyncio.wrap_future(future)
+
+        await websocket.send_json({"type": caption_type, "start": start, "end": end, "label": label})
 
 
 @app.post("/save_data")
@@ -87,6 +408,4 @@ def save_upload_file_tmp(upload_file: UploadFile) -> Path:
 
 
 if __name__ == "__main__":
-    init()
-
     uvicorn.run(app, host="0.0.0.0", port=8000)
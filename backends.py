@@ -0,0 +1,75 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+# file names of the exported models, next to the checkpoint's config.json
+torchscript_file = "model.pt"
+onnx_file = "model.onnx"
+
+
+# number of frames the convolutional feature extractor makes of a number of samples
+def output_lengths(config, lengths):
+    for kernel, stride in zip(config.conv_kernel, config.conv_stride):
+        lengths = torch.div(lengths - kernel, stride, rounding_mode="floor") + 1
+
+    return lengths
+
+
+class TorchScriptModel:
+    """
+    A checkpoint exported by export.py to TorchScript, called like
+    HubertForCTC: model(input_values, attention_mask).logits
+    """
+
+    def __init__(self, path, device="cpu"):
+        from transformers import HubertConfig
+
+        self.config = HubertConfig.from_pretrained(path)
+        self.module = torch.jit.load(os.path.join(path, torchscript_file), map_location=device).eval()
+
+    def __call__(self, input_values, attention_mask):
+        return SimpleNamespace(logits=self.module(input_values, attention_mask)[0])
+
+    def memory_size(self):
+        return sum(t.numel() * t.element_size() for t in list(self.module.parameters()) + list(self.module.buffers()))
+
+
+class OnnxModel:
+    """
+    A checkpoint exported by export.py to ONNX, run by ONNX Runtime on cpu
+    with threads threads per call.
+    """
+
+    def __init__(self, path, threads=None):
+        import onnxruntime
+        from transformers import HubertConfig
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+
+        self.config = HubertConfig.from_pretrained(path)
+        self.filename = os.path.join(path, onnx_file)
+        self.session = onnxruntime.InferenceSession(self.filename, options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, input_values, attention_mask):
+        logits = self.session.run(["logits"], {
+            "input_values": input_values.cpu().numpy().astype(np.float32),
+            "attention_mask": attention_mask.cpu().numpy().astype(np.int64),
+        })[0]
+
+        return SimpleNamespace(logits=torch.from_numpy(logits))
+
+    def memory_size(self):
+        return os.path.getsize(self.filename)
+
+
+def load(path, backend, device="cpu"):
+    if backend == "torchscript":
+        return TorchScriptModel(path, device)
+
+    if backend == "onnx":
+        return OnnxModel(path)
+
+    raise ValueError(f"Unknown backend: {backend}")
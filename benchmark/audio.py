@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import soundfile as sf
+
+SAMPLE_RATE = 16_000
+
+
+def utterances(seconds, seed=0, sample_rate=SAMPLE_RATE):
+    """
+    Speech-like audio in pieces: voiced stretches of 0.3 - 4 s (a drifting
+    pitch with harmonics, modulated at a syllable rate of about 4 Hz) and
+    pauses of 0.1 - 1 s of low noise. The same seed gives the same samples.
+    """
+    rng = np.random.default_rng(seed)
+    remaining = int(seconds * sample_rate)
+
+    while remaining > 0:
+        n = int(rng.uniform(0.3, 4) * sample_rate)
+        t = np.arange(n) / sample_rate
+
+        pitch = rng.uniform(100, 250) * (1 + 0.1 * np.sin(2 * np.pi * rng.uniform(0.2, 1) * t))
+        phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+        voice = sum(np.sin(k * phase) / k for k in range(1, 6))
+        envelope = 0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(3, 5) * t) ** 2
+
+        voiced = 0.2 * voice * envelope + 0.02 * rng.normal(size=n)
+        pause = 0.0005 * rng.normal(size=int(rng.uniform(0.1, 1) * sample_rate))
+
+        for piece in (voiced, pause):
+            piece = piece[:remaining].astype(np.float32)
+            remaining -= len(piece)
+
+            yield piece
+
+
+def speechlike(seconds, seed=0, sample_rate=SAMPLE_RATE):
+    return np.concatenate(list(utterances(seconds, seed, sample_rate)))
+
+
+# the audio as a 16-bit wav file in directory, written once per length and seed
+def speechlike_file(directory, seconds, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"speech-{seconds}s-{seed}.wav")
+
+    if not os.path.exists(path):
+        with sf.SoundFile(path + ".tmp", "w", SAMPLE_RATE, 1, "PCM_16", format="WAV") as f:
+            for piece in utterances(seconds, seed):
+                f.write(piece)
+
+        os.replace(path + ".tmp", path)
+
+    return path
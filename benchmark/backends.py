@@ -0,0 +1,115 @@
+"""
+Parity check and speed of the acoustic model backends of recognize:
+
+    python -m benchmark.backends                                # tiny random model
+    python -m benchmark.backends --checkpoint coen22/Speech-Recognition-AWO-L --processor facebook/hubert-large-ls960-ft
+
+Exports the checkpoint with export.py, then
+
+- compares the log-probabilities of every backend with eager pytorch on
+  padded batches of several lengths, and fails (exit code 1) when they
+  differ by more than --tolerance,
+- transcribes the segments of synthetic speech (so the lengths follow
+  split.py's segment length distribution) with every backend and reports
+  the real-time factor of the acoustic model.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import export
+import recognize
+from benchmark import models
+from benchmark.audio import speechlike, SAMPLE_RATE
+from benchmark.bench import cache_dir
+from split import segment_runs
+
+backend_names = ("eager", "torchscript", "onnx")
+
+
+# eager loads the checkpoint, the other backends the exported files
+def load(paths, backend):
+    recognize.backend = backend
+
+    return recognize.load_acoustic_model(paths[backend])
+
+
+def parity(paths, lengths, tolerance):
+    rng = np.random.default_rng(0)
+    segments = [rng.normal(scale=0.1, size=length).astype(np.float32) for length in lengths]
+    reference = recognize.log_probs_batch(load(paths, "eager"), segments)
+
+    failed = False
+
+    for backend in backend_names[1:]:
+        log_probs = recognize.log_probs_batch(load(paths, backend), segments)
+        diff = max(float(np.abs(a - b).max()) for a, b in zip(reference, log_probs))
+        frames_match = all(len(a) == len(b) for a, b in zip(reference, log_probs))
+        ok = frames_match and diff <= tolerance
+        failed = failed or not ok
+
+        print(f"{backend:<12} max abs diff {diff:.2e}, frames {'match' if frames_match else 'DIFFER'}"
+              f"  {'ok' if ok else 'FAILED'}")
+
+    return not failed
+
+
+def speed(paths, seconds, repeats):
+    audio = speechlike(seconds)
+    segments = [audio[start:end] for start, end in segment_runs(audio) if end - start >= 2_048]
+    audio_seconds = sum(len(seg) for seg in segments) / SAMPLE_RATE
+    lengths = [len(seg) for seg in segments]
+
+    print(f"\n{len(segments)} segments, {np.mean(lengths) / SAMPLE_RATE:.1f}s on average, "
+          f"{audio_seconds:.0f}s of audio")
+
+    for backend in backend_names:
+        model = load(paths, backend)
+        times = []
+
+        for _ in range(repeats):
+            start = time.perf_counter()
+
+            for batch in recognize.length_buckets(lengths):
+                recognize.log_probs_batch(model, [segments[i] for i in batch])
+
+            times.append(time.perf_counter() - start)
+
+        print(f"{backend:<12} {min(times):8.3f}s  rtf {min(times) / audio_seconds:.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the acoustic model backends")
+    parser.add_argument("--checkpoint", help="HubertForCTC checkpoint (default: the tiny benchmark model)")
+    parser.add_argument("--processor", help="processor of the checkpoint (default: the tiny benchmark processor)")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="allowed log-probability difference")
+    parser.add_argument("--seconds", type=int, default=300, help="seconds of synthetic speech to time")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    tiny = os.path.join(cache_dir, "models")
+
+    if args.checkpoint is None:
+        models.install(recognize, tiny)
+
+    checkpoint = args.checkpoint or os.path.join(tiny, "am")
+    recognize.tokenizer_name = args.processor or os.path.join(tiny, "processor")
+    recognize.processor = recognize.load_processor()
+
+    with tempfile.TemporaryDirectory() as output:
+        export.export(checkpoint, output)
+        paths = {"eager": checkpoint, "torchscript": output, "onnx": output}
+
+        ok = parity(paths, [2_048, 16_000, 48_000, 160_000], args.tolerance)
+        speed(paths, args.seconds, args.repeats)
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+Benchmarks of the recognition pipeline on synthetic audio and tiny random
+models, runs offline on cpu:
+
+    python -m benchmark.bench                       # 30 s and 5 min of audio
+    python -m benchmark.bench --full                # up to 2 h
+    python -m benchmark.bench --save-baseline       # store the results as the baseline
+    python -m benchmark.bench --baseline benchmark/baseline.json
+
+Every benchmark runs in a fresh process, so its peak rss is its own. The
+time is the best of a few repeats; with a baseline, benchmarks that got
+more than --tolerance slower (or use that much more memory) are flagged
+and the exit code is 1.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from benchmark.audio import speechlike, speechlike_file
+
+here = os.path.dirname(os.path.abspath(__file__))
+cache_dir = os.path.join(here, ".cache")
+default_baseline = os.path.join(here, "baseline.json")
+
+quick_lengths = [30, 300]
+full_lengths = [30, 300, 1800, 7200]
+
+
+def best_of(repeats, fn, setup=None):
+    times = []
+
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def load_recognize():
+    import recognize
+    from benchmark import models
+
+    models.install(recognize, os.path.join(cache_dir, "models"))
+    recognize.init()
+
+    return recognize
+
+
+def bench_segment_wave(seconds):
+    from split import segment_wave
+
+    audio = speechlike(seconds)
+    elapsed = best_of(3 if seconds <= 300 else 1, lambda: segment_wave(audio))
+
+    return {"seconds": elapsed, "rtf": elapsed / seconds, "throughput": seconds / elapsed, "unit": "audio s/s"}
+
+
+def bench_beam_search(seconds):
+    recognize = load_recognize()
+
+    # peaked posteriors around a random path, 50 frames per second like the real model
+    rng = np.random.default_rng(0)
+    n_frames = seconds * 50
+    logits = rng.normal(size=(n_frames, 32)).astype(np.float32)
+    path = np.where(rng.random(n_frames) < 0.6, 0, rng.integers(4, 32, n_frames))
+    logits[np.arange(n_frames), path] += 4
+    log_probs = logits - np.logaddexp.reduce(logits, axis=1, keepdims=True)
+
+    elapsed = best_of(3, lambda: recognize.beam_search_decoder(log_probs, recognize.beam_size))
+
+    return {"seconds": elapsed, "rtf": elapsed / seconds, "throughput": n_frames / elapsed, "unit": "frames/s"}
+
+
+def bench_lm_prob(n_sentences):
+    recognize = load_recognize()
+
+    rng = np.random.default_rng(0)
+    words = ["DE", "HET", "EEN", "IK", "WAS", "IN", "OP", "MET", "HUIS", "KERK", "BOER", "JAAR", "MOEDER"]
+    sentences = [" ".join(rng.choice(words, rng.integers(3, 15))) for _ in range(n_sentences)]
+
+    elapsed = best_of(5, lambda: recognize.lm_probs(sentences), setup=recognize.lm_cache.clear)
+
+    return {"seconds": elapsed, "throughput": n_sentences / elapsed, "unit": "sentences/s"}
+
+
+def bench_predict_file(seconds):
+    recognize = load_recognize()
+    filename = speechlike_file(os.path.join(cache_dir, "audio"), seconds)
+
+    # transcribe_file skips the transcription cache
+    elapsed = best_of(3 if seconds <= 300 else 1,
+                      lambda: asyncio.run(recognize.transcribe_file(filename, audio_format="none")))
+
+    return {"seconds": elapsed, "rtf": elapsed / seconds, "throughput": seconds / elapsed, "unit": "audio s/s"}
+
+
+benchmarks = {
+    "segment_wave": bench_segment_wave,
+    "beam_search_decoder": bench_beam_search,
+    "lm_prob": bench_lm_prob,
+    "predict_file": bench_predict_file,
+}
+
+
+def run(name, size):
+    result = benchmarks[name](size)
+    # kilobytes on linux
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return result
+
+
+def run_isolated(name, size):
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run, name, size).result()
+
+
+def plan(lengths, only=None):
+    jobs = [("segment_wave", seconds) for seconds in lengths]
+    jobs += [("beam_search_decoder", 30), ("lm_prob", 200)]
+    jobs += [("predict_file", seconds) for seconds in lengths]
+
+    return [(name, size) for name, size in jobs if only is None or name in only]
+
+
+def machine():
+    import torch
+
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+
+        for metric in ("seconds", "peak_rss_mb"):
+            ratio = result[metric] / baseline[key][metric]
+
+            if ratio > 1 + tolerance:
+                regressions.append(f"{key} {metric}: {baseline[key][metric]:.3f} -> {result[metric]:.3f} "
+                                   f"({ratio:.2f}x)")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the recognition pipeline")
+    parser.add_argument("--lengths", help="comma separated audio lengths in seconds")
+    parser.add_argument("--full", action="store_true", help=f"use {full_lengths} seconds of audio")
+    parser.add_argument("--only", help="comma separated benchmark names")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare against this results file")
+    parser.add_argument("--save-baseline", action="store_true", help=f"write the results to {default_baseline}")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before flagging")
+    args = parser.parse_args()
+
+    if args.lengths:
+        lengths = [int(length) for length in args.lengths.split(",")]
+    else:
+        lengths = full_lengths if args.full else quick_lengths
+
+    only = args.only.split(",") if args.only else None
+    results = {}
+
+    for name, size in plan(lengths, only):
+        key = f"{name}/{size}"
+        result = run_isolated(name, size)
+        results[key] = result
+
+        rtf = f"  rtf {result['rtf']:.4f}" if "rtf" in result else ""
+        print(f"{key:<28} {result['seconds']:9.3f}s  {result['throughput']:12.1f} {result['unit']:<12}"
+              f"{rtf}  peak rss {result['peak_rss_mb']:.0f} MB")
+
+    report = {"machine": machine(), "results": results}
+
+    for path in [args.output, default_baseline if args.save_baseline else None]:
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+
+            print("Saved", path)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        if baseline["machine"] != report["machine"]:
+            print("Baseline is from another machine:", baseline["machine"])
+
+        regressions = compare(results, baseline["results"], args.tolerance)
+
+        for regression in regressions:
+            print("REGRESSION", regression)
+
+        if regressions:
+            sys.exit(1)
+
+        print("No regressions against", args.baseline)
+
+
+if __name__ == "__main__":
+    main()
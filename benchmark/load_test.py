@@ -0,0 +1,278 @@
+"""
+Load test of app.py: starts the server in this process with the tiny
+benchmark models and sends it uploads of synthetic audio.
+
+    python -m benchmark.load_test --concurrency 4 --duration 60
+    python -m benchmark.load_test --rate 0.5 --mix transcribe=1,transcribe_async=1
+
+With --concurrency a fixed number of clients send requests back to back,
+with --rate requests start at fixed intervals whether or not earlier ones
+finished (so a saturated server shows up as growing latency and 503s).
+Reports latency percentiles per endpoint, time to first segment for
+/transcribe_async, error and 503 rates, and the cpu and rss of the process
+over time. The load generator runs in the same process, its cpu is
+included.
+"""
+import argparse
+import asyncio
+import json
+import os
+import itertools
+import random
+import tempfile
+import threading
+import time
+
+import httpx
+import numpy as np
+
+from benchmark.audio import speechlike_file
+from benchmark.bench import cache_dir
+from cache import TranscriptionCache
+
+endpoints = ("transcribe", "transcribe_async")
+
+
+def start_server(port):
+    import uvicorn
+
+    import app
+    import recognize
+    from benchmark import models
+
+    models.install(recognize, os.path.join(cache_dir, "models"))
+
+    # an empty cache that stores nothing, so no entries of earlier runs are served (uploads are also
+    # made unique, see unique_upload, so none share a transcription in flight)
+    cache = TranscriptionCache(tempfile.mkdtemp(prefix="load-test-cache-"), 0)
+    recognize.transcription_cache = cache
+    app.transcription_cache = cache
+
+    server = uvicorn.Server(uvicorn.Config(app.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="server", daemon=True).start()
+
+    return server
+
+
+async def wait_ready(client, timeout=300):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/ready")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+
+        await asyncio.sleep(0.5)
+
+    raise TimeoutError("Server did not get ready")
+
+
+# rss and cpu use of this process, from /proc on linux
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except OSError:
+        return float("nan")
+
+
+class ResourceSampler:
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="resource-sampler", daemon=True)
+
+    def run(self):
+        start = time.monotonic()
+        last_wall, last_cpu = start, time.process_time()
+
+        while not self.stopped.wait(self.interval):
+            wall, cpu = time.monotonic(), time.process_time()
+            self.samples.append({"time": wall - start, "cpu_percent": 100 * (cpu - last_cpu) / (wall - last_wall),
+                                 "rss_mb": rss_mb()})
+            last_wall, last_cpu = wall, cpu
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+# the wav with the request number in the lowest bit of its first 32 samples, inaudible but
+# every upload has different bytes and is transcribed on its own
+def unique_upload(data, number):
+    data = bytearray(data)
+    first = data.index(b"data") + 8
+
+    for bit in range(32):
+        data[first + 2 * bit] = data[first + 2 * bit] & 0xFE | (number >> bit) & 1
+
+    return bytes(data)
+
+
+async def send(client, endpoint, filename, number):
+    result = {"endpoint": endpoint, "file": os.path.basename(filename)}
+    start = time.perf_counter()
+
+    try:
+        with open(filename, "rb") as f:
+            files = {"file": (os.path.basename(filename), unique_upload(f.read(), number), "audio/wav")}
+
+        params = {"audio_format": "none"}
+
+        if endpoint == "transcribe":
+            response = await client.post("/transcribe/1", files=files, params=params)
+            await response.aread()
+        else:
+            async with client.stream("POST", "/transcribe_async/1", files=files, params=params) as response:
+                async for line in response.aiter_lines():
+                    if line and "first_segment" not in result:
+                        result["first_segment"] = time.perf_counter() - start
+
+        result["status"] = response.status_code
+    except httpx.HTTPError as e:
+        result["status"] = None
+        result["error"] = type(e).__name__
+
+    result["latency"] = time.perf_counter() - start
+
+    return result
+
+
+async def generate(client, args, files, weights):
+    rng = random.Random(args.seed)
+    results = []
+    tasks = []
+    deadline = time.monotonic() + args.duration
+
+    numbers = itertools.count()
+
+    def pick():
+        return rng.choices(endpoints, weights)[0], rng.choice(files), next(numbers)
+
+    async def closed_loop():
+        while time.monotonic() < deadline:
+            results.append(await send(client, *pick()))
+
+    if args.rate:
+        next_start = time.monotonic()
+
+        while next_start < deadline:
+            await asyncio.sleep(max(0.0, next_start - time.monotonic()))
+            tasks.append(asyncio.create_task(send(client, *pick())))
+            next_start += 1 / args.rate
+
+        results.extend(await asyncio.gather(*tasks))
+    else:
+        await asyncio.gather(*[closed_loop() for _ in range(args.concurrency)])
+
+    return results
+
+
+def percentiles(values):
+    if not values:
+        return {}
+
+    return {name: float(np.percentile(values, q)) for name, q in [("p50", 50), ("p90", 90), ("p99", 99), ("max", 100)]}
+
+
+def summarize(results, samples, elapsed):
+    summary = {"requests": len(results), "throughput": len(results) / elapsed, "endpoints": {}}
+
+    for endpoint in endpoints:
+        done = [result for result in results if result["endpoint"] == endpoint]
+
+        if not done:
+            continue
+
+        ok = [result for result in done if result["status"] == 200]
+
+        summary["endpoints"][endpoint] = {
+            "requests": len(done),
+            "latency": percentiles([result["latency"] for result in ok]),
+            "first_segment": percentiles([result["first_segment"] for result in ok if "first_segment" in result]),
+            "rate_503": sum(result["status"] == 503 for result in done) / len(done),
+            "error_rate": sum(result["status"] not in (200, 503) for result in done) / len(done),
+        }
+
+    if samples:
+        summary["cpu_percent"] = percentiles([sample["cpu_percent"] for sample in samples])
+        summary["rss_mb"] = percentiles([sample["rss_mb"] for sample in samples])
+
+    return summary
+
+
+def print_summary(summary, samples):
+    print(f"\n{summary['requests']} requests, {summary['throughput']:.2f} requests/s")
+
+    for endpoint, stats in summary["endpoints"].items():
+        print(f"\n/{endpoint}: {stats['requests']} requests, 503 {100 * stats['rate_503']:.1f}%, "
+              f"errors {100 * stats['error_rate']:.1f}%")
+
+        for name in ("latency", "first_segment"):
+            if stats[name]:
+                print(f"  {name:<14}" + "  ".join(f"{q} {value:7.3f}s" for q, value in stats[name].items()))
+
+    print("\n  time   cpu %   rss MB")
+
+    for sample in samples:
+        print(f"{sample['time']:6.0f}  {sample['cpu_percent']:6.0f}  {sample['rss_mb']:7.0f}")
+
+
+async def run(args):
+    weights = [float(dict(part.split("=") for part in args.mix.split(",")).get(endpoint, 0))
+               for endpoint in endpoints]
+    files = [speechlike_file(os.path.join(cache_dir, "audio"), seconds, seed)
+             for seconds in args.lengths for seed in range(args.files)]
+
+    server = start_server(args.port)
+    sampler = ResourceSampler(args.sample_interval)
+
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=args.timeout) as client:
+        await wait_ready(client)
+
+        sampler.start()
+        start = time.perf_counter()
+        results = await generate(client, args, files, weights)
+        elapsed = time.perf_counter() - start
+        sampler.stop()
+
+    server.should_exit = True
+
+    summary = summarize(results, sampler.samples, elapsed)
+    print_summary(summary, sampler.samples)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "summary": summary, "samples": sampler.samples, "requests": results}, f,
+                      indent=2)
+
+        print("Saved", args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the transcription server")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--concurrency", type=int, default=4, help="clients sending requests back to back")
+    load.add_argument("--rate", type=float, help="requests started per second")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to keep sending requests")
+    parser.add_argument("--mix", default="transcribe=1,transcribe_async=1", help="relative share of each endpoint")
+    parser.add_argument("--lengths", type=lambda value: [int(length) for length in value.split(",")],
+                        default=[10, 30, 60], help="comma separated upload lengths in seconds")
+    parser.add_argument("--files", type=int, default=2, help="different files per length")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=600, help="seconds before a request is an error")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="seconds between cpu/rss samples")
+    parser.add_argument("--output", help="write the summary, samples and every request to this json file")
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import json
+import os
+
+import torch
+
+# character vocab of the acoustic model, in the layout of the real checkpoint's tokenizer
+characters = ["<pad>", "<s>", "</s>", "<unk>", "|"] + list("ETAONIHSRDLUMWCFGYPBVKJXQZ'")
+
+
+def build(directory, seed=0):
+    """
+    Saves small randomly initialized models with the real architectures to
+    directory: a processor, a HuBERT ctc model and a RoBERTa masked lm
+    (byte level, no merges). They produce nonsense, but run the same code
+    paths as the real models offline and on cpu in seconds.
+    """
+    from transformers import RobertaConfig, RobertaForMaskedLM, RobertaTokenizer, HubertConfig, HubertForCTC, \
+        Wav2Vec2CTCTokenizer, Wav2Vec2FeatureExtractor, Wav2Vec2Processor
+    from transformers.models.roberta.tokenization_roberta import bytes_to_unicode
+
+    torch.manual_seed(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    with open(os.path.join(directory, "ctc_vocab.json"), "w") as f:
+        json.dump({token: i for i, token in enumerate(characters)}, f)
+
+    feature_extractor = Wav2Vec2FeatureExtractor(feature_size=1, sampling_rate=16000, padding_value=0.0,
+                                                 do_normalize=True, return_attention_mask=True)
+    tokenizer = Wav2Vec2CTCTokenizer(os.path.join(directory, "ctc_vocab.json"))
+    Wav2Vec2Processor(feature_extractor=feature_extractor, tokenizer=tokenizer).save_pretrained(
+        os.path.join(directory, "processor"))
+
+    am = HubertForCTC(HubertConfig(vocab_size=len(characters), hidden_size=64, num_hidden_layers=2,
+                                   num_attention_heads=2, intermediate_size=128, conv_dim=(32,) * 7,
+                                   feat_extract_norm="layer", do_stable_layer_norm=True,
+                                   num_conv_pos_embeddings=16, num_conv_pos_embedding_groups=4))
+    am.save_pretrained(os.path.join(directory, "am"))
+
+    lm_tokens = ["<s>", "<pad>", "</s>", "<unk>"] + list(bytes_to_unicode().values()) + ["<mask>"]
+    lm_directory = os.path.join(directory, "lm")
+    os.makedirs(lm_directory, exist_ok=True)
+
+    with open(os.path.join(lm_directory, "vocab.json"), "w") as f:
+        json.dump({token: i for i, token in enumerate(lm_tokens)}, f)
+
+    with open(os.path.join(lm_directory, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+
+    RobertaTokenizer(os.path.join(lm_directory, "vocab.json"), os.path.join(lm_directory, "merges.txt")) \
+        .save_pretrained(lm_directory)
+    RobertaForMaskedLM(RobertaConfig(vocab_size=len(lm_tokens), hidden_size=64, num_hidden_layers=2,
+                                     num_attention_heads=2, intermediate_size=128, max_position_embeddings=514,
+                                     pad_token_id=1)).save_pretrained(lm_directory)
+
+
+# point recognize at the models in directory instead of the published checkpoints
+def install(recognize, directory):
+    if not os.path.exists(os.path.join(directory, "am", "config.json")):
+        build(directory)
+
+    recognize.tokenizer_name = os.path.join(directory, "processor")
+    recognize.lm_name = os.path.join(directory, "lm")
+    recognize.registry.register(recognize.default_model_id, os.path.join(directory, "am"))
@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+
+try:
+    import fcntl
+except ImportError:
+    # windows, processes do not share a cache directory there
+    fcntl = None
+
+
+def file_digest(filename, block_size=1024 ** 2):
+    digest = hashlib.sha256()
+
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+# key of the results of some settings on a file with the given digest
+def settings_key(digest, settings):
+    settings = json.dumps(settings, sort_keys=True)
+
+    return hashlib.sha256((digest + settings).encode("utf-8")).hexdigest()
+
+
+class TranscriptionCache:
+    """
+    Stores transcriptions on disk as json files named by a hash of the audio
+    bytes and the settings that produced them.
+
+    The files are kept in least-recently-used order (their modification time
+    is bumped on every hit, so the order survives restarts); when they take
+    more than max_bytes the least recently used are removed, max_bytes 0
+    stores nothing. Concurrent requests for the same key share one
+    computation.
+
+    All state is on disk, so processes sharing the directory (the workers
+    of serve.py) see each other's entries and keep to one max_bytes: every
+    put scans the directory and evicts under a lock file.
+    """
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        try:
+            with open(self.path(key)) as f:
+                value = json.load(f)
+
+            os.utime(self.path(key))
+        except (OSError, ValueError):
+            # not cached, or removed or damaged behind our back
+            return None
+
+        return value
+
+    def put(self, key, value):
+        if self.max_bytes <= 0:
+            return
+
+        # written next to the entry and renamed, so readers never see half a file
+        with NamedTemporaryFile("w", dir=self.directory, suffix=".tmp", delete=False) as f:
+            json.dump(value, f)
+
+        os.replace(f.name, self.path(key))
+        self.evict()
+
+    # threads of this process and other processes evict one at a time
+    @contextmanager
+    def directory_lock(self):
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+
+            with open(os.path.join(self.directory, ".lock"), "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def evict(self):
+        with self.directory_lock():
+            files = []
+
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(".json"):
+                    continue
+
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+            # least recently used first, the newest entry is always kept
+            files.sort()
+            total = sum(size for _, size, _ in files)
+
+            for _, size, path in files[:-1]:
+                if total <= self.max_bytes:
+                    break
+
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+                total -= size
+
+    async def get_or_compute(self, key, compute):
+        """
+        Returns the cached value of key, or awaits compute() and stores its
+        result. Callers asking for a key that is being computed wait for that
+        computation, which keeps running when the caller that started it is
+        cancelled.
+        """
+        loop = asyncio.get_running_loop()
+
+        if key not in self.in_flight:
+            value = await loop.run_in_executor(None, self.get, key)
+
+            if value is not None:
+                return value
+
+        if key not in self.in_flight:
+            self.in_flight[key] = asyncio.ensure_future(self.compute(key, compute))
+
+        return await asyncio.shield(self.in_flight[key])
+
+    async def compute(self, key, compute):
+        try:
+            value = await compute()
+            await asyncio.get_running_loop().run_in_executor(None, self.put, key, value)
+
+            return value
+        finally:
+            del self.in_flight[key]
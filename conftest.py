@@ -0,0 +1 @@
+# the modules live at the repository root, this file puts it on sys.path for tests/
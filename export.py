@@ -0,0 +1,86 @@
+"""
+Exports a HubertForCTC checkpoint (a published model or a checkpoint of
+training/train_hubert_mcv-interview.py) for the torchscript and onnx
+backends of recognize:
+
+    python export.py coen22/Speech-Recognition-AWO-L
+    python export.py hubert-mcv-xlarge-aug-cgn/checkpoint-1000 --output exported --formats onnx
+
+The batch size and the number of samples are dynamic. The model files are
+written next to a copy of the checkpoint's config.json, so the output
+directory can be registered as an acoustic model path.
+"""
+import argparse
+import os
+
+import torch
+
+from backends import torchscript_file, onnx_file
+
+
+# a padded batch of two lengths, so the attention mask handling is part of the traced graph
+def example_inputs(lengths=(48_000, 32_000)):
+    generator = torch.Generator().manual_seed(0)
+    input_values = torch.randn(len(lengths), max(lengths), generator=generator)
+    attention_mask = torch.zeros(len(lengths), max(lengths), dtype=torch.long)
+
+    for i, length in enumerate(lengths):
+        attention_mask[i, :length] = 1
+        input_values[i, length:] = 0
+
+    return input_values, attention_mask
+
+
+def load_checkpoint(checkpoint):
+    from transformers import HubertForCTC
+
+    # torchscript=True makes the model return plain tuples
+    return HubertForCTC.from_pretrained(checkpoint, torchscript=True).eval()
+
+
+def export_torchscript(model, output):
+    with torch.inference_mode():
+        traced = torch.jit.trace(model, example_inputs(), check_trace=False)
+
+    traced.save(os.path.join(output, torchscript_file))
+
+
+def export_onnx(model, output):
+    with torch.no_grad():
+        torch.onnx.export(model, example_inputs(), os.path.join(output, onnx_file),
+                          input_names=["input_values", "attention_mask"], output_names=["logits"],
+                          dynamic_axes={"input_values": {0: "batch", 1: "samples"},
+                                        "attention_mask": {0: "batch", 1: "samples"},
+                                        "logits": {0: "batch", 1: "frames"}},
+                          opset_version=17, dynamo=False)
+
+
+exporters = {"torchscript": export_torchscript, "onnx": export_onnx}
+
+
+def export(checkpoint, output=None, formats=("torchscript", "onnx")):
+    output = output or checkpoint
+    os.makedirs(output, exist_ok=True)
+
+    model = load_checkpoint(checkpoint)
+    model.config.save_pretrained(output)
+
+    for name in formats:
+        print("Exporting", name)
+        exporters[name](model, output)
+
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a HubertForCTC checkpoint to torchscript and onnx")
+    parser.add_argument("checkpoint", help="checkpoint directory or model name")
+    parser.add_argument("--output", help="directory for the exported models (default: the checkpoint directory)")
+    parser.add_argument("--formats", default="torchscript,onnx", help="comma separated formats")
+    args = parser.parse_args()
+
+    print("Exported to", export(args.checkpoint, args.output, args.formats.split(",")))
+
+
+if __name__ == "__main__":
+    main()
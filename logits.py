@@ -0,0 +1,130 @@
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+class LogitStore:
+    """
+    Keeps the acoustic model output of transcribed files, so they can be
+    decoded again with other decoder settings.
+
+    Every file (key: hash of its bytes and the acoustic model settings) is a
+    float16 .npy file with the (frames, classes) log-probabilities of all
+    its segments one after another, and a json index with the sample and
+    frame offsets of each segment. The .npy files are memory-mapped.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key, ".json"))
+
+    def keys(self):
+        if not os.path.isdir(self.directory):
+            return []
+
+        return sorted(name[:-5] for name in os.listdir(self.directory) if name.endswith(".json"))
+
+    # segments as (start, end, log_probs)
+    def put(self, key, segments, filename=None):
+        os.makedirs(self.directory, exist_ok=True)
+
+        n_frames = sum(len(log_probs) for _, _, log_probs in segments)
+        n_classes = segments[0][2].shape[1] if segments else 0
+
+        data = np.lib.format.open_memmap(self.path(key, ".npy"), mode="w+", dtype=np.float16,
+                                         shape=(n_frames, n_classes))
+        index = []
+        offset = 0
+
+        for start, end, log_probs in segments:
+            data[offset:offset + len(log_probs)] = log_probs
+            index.append({"start": start, "end": end, "frames": [offset, offset + len(log_probs)]})
+            offset += len(log_probs)
+
+        data.flush()
+        del data
+
+        # the index is written last, a file only counts as stored once it exists
+        with open(self.path(key, ".json"), "w") as f:
+            json.dump({"filename": filename, "segments": index}, f)
+
+    def get(self, key):
+        with open(self.path(key, ".json")) as f:
+            index = json.load(f)
+
+        data = np.load(self.path(key, ".npy"), mmap_mode="r")
+
+        return index["filename"], [(segment["start"], segment["end"], data[slice(*segment["frames"])])
+                                   for segment in index["segments"]]
+
+
+# re-decoding runs in worker processes with the settings applied to their own copy of recognize
+def init_worker(settings):
+    import torch
+    import recognize
+
+    torch.set_num_threads(1)
+
+    for name, value in settings.items():
+        setattr(recognize, name, value)
+
+    recognize.processor = recognize.load_processor()
+
+
+def decode_stored(directory, key):
+    import recognize
+
+    filename, segments = LogitStore(directory).get(key)
+    records = []
+
+    for start, end, log_probs in segments:
+        label = recognize.decode(np.asarray(log_probs, dtype=np.float32))
+        records.append({"label": label, "start": start, "end": end})
+
+    return key, filename, records
+
+
+# decode all stored files (or the given keys) with other decoder settings, e.g.
+# {"beam_size": 10, "default_lm_mode": "both", "am_weight": 0.7, "lm_weight": 0.3}
+def redecode(directory, output_dir, settings, keys=None, workers=None):
+    keys = LogitStore(directory).keys() if keys is None else keys
+    os.makedirs(output_dir, exist_ok=True)
+
+    start_time = time.perf_counter()
+
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(settings,)) as pool:
+        jobs = [pool.submit(decode_stored, directory, key) for key in keys]
+
+        for i, job in enumerate(jobs):
+            key, filename, records = job.result()
+
+            with open(os.path.join(output_dir, key + ".json"), "w") as f:
+                json.dump({"filename": filename, "settings": settings, "segments": records}, f)
+
+            print(f"{i + 1}/{len(keys)}", filename or key)
+
+    print(f"Decoded {len(keys)} files in {time.perf_counter() - start_time:.1f}s")
+
+
+# python logits.py logits_dir output_dir [name=value ...], e.g. beam_size=10 default_lm_mode=both lm_weight=0.3
+if __name__ == "__main__":
+    settings = {}
+
+    for arg in sys.argv[3:]:
+        name, value = arg.split("=", 1)
+
+        try:
+            settings[name] = json.loads(value)
+        except ValueError:
+            settings[name] = value
+
+    redecode(sys.argv[1], sys.argv[2], settings)
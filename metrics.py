@@ -0,0 +1,148 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# every metric created is listed here and rendered by render()
+registry = []
+
+seconds_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+
+    if not pairs:
+        return ""
+
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    """
+    A metric in the Prometheus text format, with one value per combination
+    of label values. Values are updated under a lock, an update costs a
+    dict lookup.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def collect(self):
+        with self.lock:
+            return dict(self.values)
+
+    def samples(self):
+        for key, value in sorted(self.collect().items()):
+            yield self.name + label_text(self.labels, key), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{name} {value}" for name, value in self.samples()]
+
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down; set it, or pass a function that returns
+    the current value when the metrics are rendered.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+
+        with self.lock:
+            self.values[key] = value
+
+    def collect(self):
+        if self.function is not None:
+            return {(): self.function()}
+
+        return super().collect()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=seconds_buckets):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect_left(self.buckets, value)
+
+        with self.lock:
+            if key not in self.values:
+                # counts per bucket (the last one is +Inf), sum
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            counts = self.values[key]
+            counts[0][i] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        with self.lock:
+            return {key: ([*counts], total) for key, (counts, total) in self.values.items()}
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.collect().items()):
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield self.name + "_bucket" + label_text(self.labels, key, [("le", bound)]), cumulative
+
+            yield self.name + "_sum" + label_text(self.labels, key), total
+            yield self.name + "_count" + label_text(self.labels, key), cumulative
+
+
+def render():
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+# seconds spent per stage of a transcription
+stage_seconds = Histogram("asr_stage_seconds", "Seconds spent per transcription stage", ["stage"])
+
+segments_total = Counter("asr_segments_total", "Segments transcribed")
+audio_seconds_total = Counter("asr_audio_seconds_total", "Seconds of audio transcribed")
+real_time_factor = Histogram("asr_real_time_factor", "Inference seconds per second of audio of a batch",
+                             buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5))
+decoded_segments = Counter("asr_decoded_segments_total", "Segments per decoding path", ["path"])
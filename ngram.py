@@ -0,0 +1,252 @@
+import json
+import re
+import sys
+import unicodedata
+from collections import Counter
+from functools import lru_cache
+from math import log
+
+import numpy as np
+
+# reserved word ids
+BOS = 0
+EOS = 1
+UNK = 2
+special_words = ["<s>", "</s>", "<unk>"]
+
+
+# same text as the acoustic model was trained on: no accents, no punctuation, upper case
+def normalize_text(text):
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^A-Za-z' ]+", " ", text)
+
+    return " ".join(text.upper().split())
+
+
+# sentences of an alignment json ([{"label": ...}, ...]), a common voice tsv or a text file with one per line
+def read_sentences(filename):
+    if filename.endswith(".json"):
+        with open(filename) as f:
+            return [record["label"] for record in json.load(f) if record.get("label")]
+
+    with open(filename, encoding="utf-8") as f:
+        if filename.endswith(".tsv"):
+            header = f.readline().rstrip("\n").split("\t")
+            column = header.index("sentence")
+
+            return [line.rstrip("\n").split("\t")[column] for line in f]
+
+        return [line.strip() for line in f]
+
+
+class NgramLM:
+    """
+    Word n-gram language model with interpolated absolute discounting.
+
+    All n-grams are packed into one sorted uint64 array (word id + 1 in
+    bits per word), next to their log-probability and the log backoff weight
+    for when they are used as a context. Unseen n-grams back off to the
+    shorter context, lookups are a binary search.
+    """
+
+    def __init__(self, vocab, keys, log_probs, backoffs, order):
+        self.words = list(vocab)
+        self.vocab = {word: i for i, word in enumerate(self.words)}
+        self.keys = keys
+        self.log_probs = log_probs
+        self.backoffs = backoffs
+        self.order = order
+        self.bits = len(self.words).bit_length()
+
+    @classmethod
+    def build(cls, sentences, order=3):
+        counts = Counter(word for sentence in sentences for word in sentence.split())
+        words = special_words + sorted(counts)
+        vocab = {word: i for i, word in enumerate(words)}
+        bits = len(words).bit_length()
+
+        if order * bits > 64:
+            raise ValueError(f"{len(words)} words do not fit a {order}-gram key")
+
+        ngrams = [Counter() for _ in range(order + 1)]
+
+        for sentence in sentences:
+            ids = [BOS] + [vocab[word] for word in sentence.split()] + [EOS]
+
+            for n in range(1, order + 1):
+                # <s> is only a context
+                for i in range(max(1, n - 1), len(ids)):
+                    ngrams[n][tuple(ids[i - n + 1:i + 1])] += 1
+
+        # total count and number of distinct followers per context
+        totals = [Counter() for _ in range(order + 1)]
+        types = [Counter() for _ in range(order + 1)]
+
+        for n in range(1, order + 1):
+            for ngram, count in ngrams[n].items():
+                totals[n][ngram[:-1]] += count
+                types[n][ngram[:-1]] += 1
+
+        table = {}
+        backoff = {}
+
+        for n in range(1, order + 1):
+            n1 = sum(1 for count in ngrams[n].values() if count == 1)
+            n2 = sum(1 for count in ngrams[n].values() if count == 2)
+            discount = min(max(n1 / (n1 + 2 * n2), 0.1), 0.9) if n1 else 0.5
+
+            for context, total in totals[n].items():
+                backoff[context] = discount * types[n][context] / total
+
+            for ngram, count in ngrams[n].items():
+                context = ngram[:-1]
+                lower = 1 / (len(words) - 1) if n == 1 else table[ngram[1:]]
+                table[ngram] = (count - discount) / totals[n][context] + backoff[context] * lower
+
+            if n == 1:
+                table[(UNK,)] = table.get((UNK,), 0) + backoff[()] / (len(words) - 1)
+
+        keys = {}
+
+        for ngram, prob in table.items():
+            keys[ngram] = [log(prob), 0.0]
+
+        for context, weight in backoff.items():
+            if context:
+                keys.setdefault(context, [0.0, 0.0])[1] = log(weight)
+
+        packed = sorted((cls.pack(ngram, bits), *values) for ngram, values in keys.items())
+
+        return cls(words,
+                   np.array([key for key, _, _ in packed], dtype=np.uint64),
+                   np.array([value for _, value, _ in packed], dtype=np.float32),
+                   np.array([value for _, _, value in packed], dtype=np.float32),
+                   order)
+
+    @staticmethod
+    def pack(ngram, bits):
+        key = 0
+
+        for word in ngram:
+            key = (key << bits) | (word + 1)
+
+        return key
+
+    # (log-prob, log backoff) of a stored n-gram or None
+    def lookup(self, ngram):
+        key = np.uint64(self.pack(ngram, self.bits))
+        i = np.searchsorted(self.keys, key)
+
+        if i < len(self.keys) and self.keys[i] == key:
+            return float(self.log_probs[i]), float(self.backoffs[i])
+
+    def word_id(self, word):
+        return self.vocab.get(word, UNK)
+
+    # natural log-probability of a word id after a history of word ids
+    def log_prob(self, history, word):
+        history = tuple(history)[-(self.order - 1):] if self.order > 1 else ()
+        weight = 0.0
+
+        for n in range(len(history), -1, -1):
+            context = history[len(history) - n:]
+            entry = self.lookup(context + (word,))
+
+            if entry is not None:
+                return weight + entry[0]
+
+            if n > 0:
+                entry = self.lookup(context)
+
+                if entry is not None:
+                    weight += entry[1]
+
+        return weight + self.lookup((UNK,))[0]
+
+    def sentence_log_prob(self, sentence):
+        history = [BOS]
+        total = 0.0
+
+        for word in [self.word_id(word) for word in sentence.split()] + [EOS]:
+            total += self.log_prob(history, word)
+            history.append(word)
+
+        return total
+
+    def save(self, filename):
+        np.savez(filename, vocab=np.frombuffer("\n".join(self.words).encode("utf-8"), dtype=np.uint8),
+                 keys=self.keys, log_probs=self.log_probs, backoffs=self.backoffs, order=self.order)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            vocab = data["vocab"].tobytes().decode("utf-8").split("\n")
+
+            return cls(vocab, data["keys"], data["log_probs"], data["backoffs"], int(data["order"]))
+
+
+class ShallowFusion:
+    """
+    Adds weighted n-gram scores to the ctc beam search.
+
+    A prefix's state is (history of word ids, characters of the current
+    word); every time a word delimiter completes a word its log-probability
+    times weight plus word_bonus is added to the prefix score.
+    """
+
+    def __init__(self, lm, labels, delimiter="|", weight=0.5, word_bonus=1.0):
+        self.lm = lm
+        self.log_prob = lru_cache(maxsize=100_000)(lm.log_prob)
+        # special tokens such as <pad> are not part of words
+        self.labels = [label if len(label) == 1 else "" for label in labels]
+        self.delimiter = self.labels.index(delimiter)
+        self.weight = weight
+        self.word_bonus = word_bonus
+
+    def start(self):
+        return (BOS,), ""
+
+    def score_word(self, history, word):
+        word = self.lm.word_id(word)
+        score = self.weight * self.log_prob(history, word) + self.word_bonus
+
+        return score, (history + (word,))[-max(1, self.lm.order - 1):]
+
+    # new state and score change after appending a character
+    def extend(self, state, char):
+        history, word = state
+
+        if char != self.delimiter:
+            return (history, word + self.labels[char]), 0.0
+
+        if not word:
+            return state, 0.0
+
+        score, history = self.score_word(history, word)
+
+        return (history, ""), score
+
+    # score of the last, unfinished word
+    def finish(self, state):
+        history, word = state
+
+        return self.score_word(history, word)[0] if word else 0.0
+
+
+# python ngram.py ngram.npz [--order=3] sentences.json|sentences.tsv|sentences.txt ...
+if __name__ == "__main__":
+    order = 3
+    files = []
+
+    for arg in sys.argv[2:]:
+        if arg.startswith("--order="):
+            order = int(arg.split("=", 1)[1])
+        else:
+            files.append(arg)
+
+    sentences = [normalize_text(sentence) for filename in files for sentence in read_sentences(filename)]
+    lm = NgramLM.build([sentence for sentence in sentences if sentence], order)
+    lm.save(sys.argv[1])
+
+    print(f"Saved {len(lm.words)} words and {len(lm.keys)} n-grams to {sys.argv[1]}")
@@ -0,0 +1,164 @@
+import asyncio
+import os
+import random
+import re
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager, ExitStack
+
+from metrics import stage_seconds
+
+# ASR_PROFILE=1 profiles every request, ASR_PROFILE_RATE=0.01 a random 1%; the rate can be
+# changed at runtime with set_sample_rate (PUT /profiling in app.py)
+sample_rate = 1.0 if os.environ.get("ASR_PROFILE") == "1" else float(os.environ.get("ASR_PROFILE_RATE", 0))
+
+# chrome traces (open in chrome://tracing or ui.perfetto.dev), only the newest max_traces are kept
+profile_dir = os.environ.get("ASR_PROFILE_DIR", os.path.join(os.path.dirname(__file__), "profiles"))
+max_traces = 20
+
+# python call stacks of every op in the trace, makes traces of a file hundreds of times larger
+with_stack = False
+
+# the torch profiler is global, one request is profiled at a time
+session_lock = threading.Lock()
+active = False
+
+
+def set_sample_rate(rate):
+    global sample_rate
+
+    sample_rate = min(max(float(rate), 0.0), 1.0)
+
+
+def should_profile(requested=False):
+    return requested or (sample_rate > 0 and random.random() < sample_rate)
+
+
+# a named range in the trace while a request is profiled, and a sample of asr_stage_seconds
+@contextmanager
+def stage(name):
+    with ExitStack() as stack:
+        stack.enter_context(stage_seconds.time(stage=name))
+
+        if active:
+            import torch.profiler
+
+            stack.enter_context(torch.profiler.record_function(name))
+
+        yield
+
+
+def trace_options():
+    import torch
+    import torch.profiler
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    # inference runs on the scheduler's worker thread, not on the thread that starts the profiler
+    try:
+        config = torch._C._profiler._ExperimentalConfig(profile_all_threads=True)
+    except (AttributeError, TypeError):
+        config = None
+
+    return {"activities": activities, "with_stack": with_stack, "experimental_config": config}
+
+
+@contextmanager
+def profiled(name, enabled=True):
+    """
+    Records a torch profiler trace, with the stage() ranges, of everything
+    the process does inside the block, and writes it to profile_dir as
+    <time>-<name>.json. Does nothing when not enabled or when another
+    request is being profiled.
+    """
+    profiler = start_profiler(enabled)
+
+    try:
+        yield profiler
+    finally:
+        if profiler is not None:
+            finish_profiler(profiler, name)
+
+
+@asynccontextmanager
+async def profiled_async(name, enabled=True, executor=None):
+    """
+    profiled() for coroutines: starting the profiler (seconds the first time)
+    and stopping it and writing the trace (seconds for a long recording) run
+    on executor, not on the event loop.
+    """
+    if not enabled:
+        yield None
+        return
+
+    loop = asyncio.get_running_loop()
+    start = loop.run_in_executor(executor, start_profiler)
+
+    try:
+        profiler = await asyncio.shield(start)
+    except asyncio.CancelledError:
+        # the profiler starts anyway and is stopped again right away
+        profiler = await start
+
+        if profiler is not None:
+            await loop.run_in_executor(executor, finish_profiler, profiler, name)
+
+        raise
+
+    try:
+        yield profiler
+    finally:
+        if profiler is not None:
+            await loop.run_in_executor(executor, finish_profiler, profiler, name)
+
+
+def start_profiler(enabled=True):
+    global active
+
+    if not enabled or not session_lock.acquire(blocking=False):
+        return None
+
+    try:
+        import torch.profiler
+
+        profiler = torch.profiler.profile(**trace_options())
+        profiler.start()
+        profiler.add_metadata("scope", "whole process: includes every request running at the same time")
+    except BaseException:
+        session_lock.release()
+        raise
+
+    active = True
+
+    return profiler
+
+
+def finish_profiler(profiler, name):
+    global active
+
+    active = False
+
+    try:
+        profiler.stop()
+        save_trace(profiler, name)
+    finally:
+        session_lock.release()
+
+
+def save_trace(profiler, name):
+    os.makedirs(profile_dir, exist_ok=True)
+
+    name = re.sub(r"[^\w.-]+", "_", name)[:64]
+    path = os.path.join(profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}.json")
+    profiler.export_chrome_trace(path)
+
+    print("Saved trace", path)
+
+    traces = sorted((entry for entry in os.scandir(profile_dir) if entry.name.endswith(".json")),
+                    key=lambda entry: entry.stat().st_mtime)
+
+    for entry in traces[:max(0, len(traces) - max_traces)]:
+        os.remove(entry.path)
@@ -1,25 +1,27 @@
 import asyncio
 import base64
-import heapq
-import math
-from numpy import array
+import importlib.util
+import io
 import numpy as np
 import soundfile as sf
 import torch.nn.functional
 import torch
 import os
 import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from math import log
 
-from scipy.io import wavfile
-from transformers import (
-    HubertForCTC,
-    Wav2Vec2Processor,
-    RobertaForMaskedLM,
-    RobertaTokenizer
-)
-from split import segment
-from tempfile import NamedTemporaryFile
+import backends
+from cache import TranscriptionCache, file_digest, settings_key
+from logits import LogitStore
+from profiling import stage, profiled_async, should_profile
+from metrics import stage_seconds, segments_total, audio_seconds_total, real_time_factor, decoded_segments
+from ngram import NgramLM, ShallowFusion
+from split import load_audio, segment_runs, iter_segments, LOOKAHEAD
+from registry import ModelRegistry
 
 lm_name = "pdelobelle/robbert-v2-dutch-base"
 tokenizer_name = "facebook/hubert-large-ls960-ft"
@@ -29,189 +31,770 @@ dirname = os.path.dirname(__file__)
 model_path = os.path.join(dirname, model_name)
 
 beam_size = 30
+
+# weights of the acoustic and roberta scores when rescoring the beams
+am_weight = 0.5
+lm_weight = 0.5
+
+# how the language model picks the transcription: not at all ("none"), a word n-gram model fused
+# into the beam search ("ngram", built with ngram.py), rescoring the beams with roberta ("roberta") or both
+lm_modes = ("none", "ngram", "roberta", "both")
+default_lm_mode = "roberta"
+
+ngram_path = os.path.join(dirname, "ngram.npz")
+ngram_weight = 0.5
+word_bonus = 1.0
+
+# adaptive decoding spends the search on uncertain segments only: segments with a confidence
+# (geometric mean of the frame posteriors of the greedy path) of at least greedy_confidence
+# are decoded greedily without lm, the others by the first (min confidence, beam width) tier they reach,
+# a width of None is beam_size
+adaptive_decoding = False
+greedy_confidence = 0.95
+beam_tiers = [(0.85, 8), (0.0, None)]
+
+# processes used to segment a file, 1 segments in the calling thread
+segment_workers = 1
+
+# total audio samples (padding included) in one acoustic model batch
+max_batch_samples = 1_600_000
+
+# segments longer than window_length are transcribed in overlapping windows,
+# both should be a multiple of the model's frame hop (320 samples)
+window_length = 160_000
+window_overlap = 32_000
+
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-working = False
+# how the acoustic model runs: "eager" pytorch, or the "torchscript" or "onnx" (onnx runtime, cpu)
+# export of the checkpoint made by export.py
+backend = "eager"
 
-processor: Wav2Vec2Processor = None
-model:HubertForCTC = None
-tokenizer:RobertaTokenizer = None
-lm_model:RobertaForMaskedLM = None
+lm_cache_size = 10_000
+lm_cache = OrderedDict()
+lm_cache_lock = threading.Lock()
 
+# transformers is imported by the loaders, so importing this module stays fast
+processor: "Wav2Vec2Processor" = None
+tokenizer: "RobertaTokenizer" = None
+lm_model: "RobertaForMaskedLM" = None
+fusion: ShallowFusion = None
+fusion_path = None
 
-def init():
-    global processor
-    global model
+init_lock = threading.Lock()
+lm_lock = threading.Lock()
+
+# set once init loaded the processor and the default model, the registry may unload the model later on;
+# init_error is the exception of a failed init
+ready = threading.Event()
+init_error: Exception = None
+
+# seconds spent loading each component
+startup_timings = {}
+
+
+def timed(name, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    startup_timings[name] = time.perf_counter() - start
+
+    print(f"Loaded {name} in {startup_timings[name]:.2f}s")
+
+    return result
+
+
+def load_processor():
+    from transformers import Wav2Vec2Processor
+
+    return Wav2Vec2Processor.from_pretrained(tokenizer_name)
+
+
+# skip the random init and load the weights straight into the model (needs accelerate),
+# safetensors checkpoints are memory-mapped either way
+def pretrained_kwargs():
+    return {"low_cpu_mem_usage": importlib.util.find_spec("accelerate") is not None}
+
+
+def load_acoustic_model(path):
+    if backend != "eager":
+        return backends.load(path, backend, device)
+
+    from transformers import HubertForCTC
+
+    return HubertForCTC.from_pretrained(path, **pretrained_kwargs()).to(device).eval()
+
+
+def load_lm():
     global tokenizer
     global lm_model
 
-    print("Loading am")
+    with lm_lock:
+        if lm_model is not None:
+            return
+
+        from transformers import RobertaForMaskedLM, RobertaTokenizer
+
+        print("Loading lm")
+
+        tokenizer = timed("lm tokenizer", RobertaTokenizer.from_pretrained, lm_name)
+        lm_model = timed("lm", lambda: RobertaForMaskedLM.from_pretrained(lm_name, **pretrained_kwargs()).eval())
+
+
+# the n-gram model spells words with the characters of the processor's vocab, it is loaded again
+# when ngram_path changed
+def load_ngram():
+    global fusion
+    global fusion_path
+
+    with lm_lock:
+        if fusion is not None and fusion_path == ngram_path:
+            return
+
+        print("Loading ngram")
+
+        lm = timed("ngram", NgramLM.load, ngram_path)
+        labels = processor.tokenizer.convert_ids_to_tokens(list(range(len(processor.tokenizer))))
+        fusion = ShallowFusion(lm, labels, processor.tokenizer.word_delimiter_token, ngram_weight, word_bonus)
+        fusion_path = ngram_path
+
+
+# acoustic models by id, extra checkpoints can be listed in models.json as {"model_id": "path"}
+default_model_id = '1'
+model_paths = {default_model_id: model_path}
+
+models_file = os.path.join(dirname, "models.json")
+
+if os.path.exists(models_file):
+    with open(models_file) as f:
+        model_paths.update(json.load(f))
+
+# loaded acoustic models share the processor and the lm, the least recently used are
+# unloaded when they take more than memory_budget bytes
+memory_budget = 8 * 1024 ** 3
+registry = ModelRegistry(load_acoustic_model, model_paths, memory_budget)
+
+# transcribed files by hash of their bytes and the settings below, at most cache_size bytes on disk
+cache_dir = os.path.join(dirname, "cache")
+cache_size = 2 * 1024 ** 3
+transcription_cache = TranscriptionCache(cache_dir, cache_size)
 
-    processor = Wav2Vec2Processor.from_pretrained(tokenizer_name)
-    model = HubertForCTC.from_pretrained(model_path).to(device)
 
-    print("Loading lm")
+# everything that changes the transcription of a file, streaming is True for the segments of iter_load_segments
+def decoder_settings(model_id=None, audio_format="wav", streaming=False):
+    model_id = model_id or default_model_id
 
-    tokenizer = RobertaTokenizer.from_pretrained(lm_name)
-    lm_model = RobertaForMaskedLM.from_pretrained(lm_name)
+    return {
+        "model": [model_id, registry.paths.get(model_id), backend],
+        "audio_format": audio_format,
+        "segmentation": ["streaming", LOOKAHEAD] if streaming else "whole",
+        "beam_size": beam_size,
+        "lm_mode": default_lm_mode,
+        "ngram": [ngram_path, ngram_weight, word_bonus],
+        "adaptive": [adaptive_decoding, greedy_confidence, beam_tiers],
+        "window": [window_length, window_overlap],
+        "weights": [am_weight, lm_weight],
+    }
 
-    print("Done")
+
+# with store_logits the acoustic model output of files transcribed by predict_file is kept in
+# logits_dir, logits.py decodes them again with other decoder settings
+store_logits = False
+logits_dir = os.path.join(dirname, "logits")
+logit_store = LogitStore(logits_dir)
+
+
+# everything that changes the acoustic model output of a file
+def acoustic_settings(model_id=None):
+    model_id = model_id or default_model_id
+
+    return {
+        "model": [model_id, registry.paths.get(model_id), backend],
+        "window": [window_length, window_overlap],
+    }
+
+
+# loads the processor, the default acoustic model and optionally the lm concurrently
+def init(with_lm=True):
+    global processor
+    global init_error
+
+    with init_lock:
+        if ready.is_set() and (lm_model is not None or not with_lm):
+            return
+
+        start = time.perf_counter()
+
+        try:
+            timed("transformers", __import__, "transformers")
+
+            with ThreadPoolExecutor() as pool:
+                jobs = [pool.submit(timed, "am", registry.get, default_model_id)]
+
+                if with_lm and default_lm_mode in ("roberta", "both"):
+                    jobs.append(pool.submit(load_lm))
+
+                if processor is None:
+                    processor = timed("processor", load_processor)
+
+                if with_lm and default_lm_mode in ("ngram", "both"):
+                    load_ngram()
+
+                for job in jobs:
+                    job.result()
+        except Exception as e:
+            init_error = e
+            print("Init failed:", repr(e))
+            raise
+
+        init_error = None
+        ready.set()
+        startup_timings["total"] = time.perf_counter() - start
+
+        print("Done", ", ".join(f"{name}: {seconds:.2f}s" for name, seconds in startup_timings.items()))
+
+
+def is_ready():
+    return ready.is_set()
 
 
 # lm prob function
 def lm_prob(sentence):
-    if tokenizer is None:
-        init()
+    return lm_probs([sentence])[0]
+
+
+def normalize_text(sentence):
+    return " ".join(sentence.split())
+
+
+# batched lm scoring of a n-best list, scores are shared between segments
+def lm_probs(sentences):
+    if lm_model is None:
+        load_lm()
+
+    keys = [normalize_text(sentence) for sentence in sentences]
+
+    with lm_cache_lock:
+        scores = {key: lm_cache[key] for key in set(keys) if key in lm_cache}
+
+        for key in scores:
+            lm_cache.move_to_end(key)
+
+    missing = sorted(set(keys) - scores.keys())
+
+    if missing:
+        # long (windowed) segments are scored on their first max_length tokens
+        max_length = lm_model.config.max_position_embeddings - 2
+        tokenize_input = tokenizer(missing, return_tensors='pt', padding=True, truncation=True, max_length=max_length)
 
-    tokenize_input = tokenizer(sentence, return_tensors='pt')
-    output = lm_model(**tokenize_input)
-    loss_fct = torch.nn.CrossEntropyLoss()
-    loss = loss_fct(output.logits.squeeze(),tokenize_input.input_ids.squeeze()).data
-    return loss.item()
+        with torch.inference_mode(), stage("lm"):
+            output = lm_model(**tokenize_input)
 
+        # mean token cross-entropy per sentence, ignoring the padding
+        loss = torch.nn.functional.cross_entropy(output.logits.transpose(1, 2), tokenize_input.input_ids,
+                                                 reduction='none')
+        mask = tokenize_input.attention_mask
+        loss = (loss * mask).sum(dim=1) / mask.sum(dim=1)
 
-# beam search
-def beam_search_decoder(data, k):
+        with lm_cache_lock:
+            for key, value in zip(missing, loss.tolist()):
+                scores[key] = value
+                lm_cache[key] = value
+
+            while len(lm_cache) > lm_cache_size:
+                lm_cache.popitem(last=False)
+
+    return [scores[key] for key in keys]
+
+
+# ctc prefix beam search
+def beam_search_decoder(data, k, blank=0, prune_log_prob=-12.0, blank_skip_log_prob=-0.001, fusion=None):
     """
-    data: (n, m) where n is number of words in sequence.
-        and m is number of classes (words in target vocab).
+    data: (n, m) log-probabilities (log_softmax output) where n is the number
+        of frames and m is the number of classes (characters in the ctc vocab).
     k: beam search parameter
+    blank: index of the ctc blank token
+    prune_log_prob: characters below this log-probability are not expanded
+    blank_skip_log_prob: frames where the blank is at least this likely only
+        advance the existing beams and never create new prefixes
+    fusion: optional language model (ngram.ShallowFusion) whose word scores
+        are added to the prefix scores while searching
+
+    Returns the k best label sequences (blanks and repeats collapsed) as
+    [sequence, score] pairs, where score is the negative log-probability of
+    the prefix (plus the fused lm score), best first.
     """
-    sequences = [[[], 0.0]]
-    # walk over each step in sequence
-    for row in data: # ----> n
-        all_candidates = []
+    data = np.asarray(data, dtype=np.float32)
+    n_classes = data.shape[1]
+    n_candidates = min(k, n_classes - 1)
+
+    # prefixes are nodes in a trie: node 0 is the empty prefix
+    parents = [-1]
+    chars = [-1]
+    children = {}
+
+    # lm state and summed lm score per node, the score of ending a word per node
+    states = [fusion.start() if fusion else None]
+    node_scores = [0.0]
+    word_ends = {}
+
+    # beams as arrays of (node, last char, log p ending in blank, log p ending in non-blank)
+    nodes = np.zeros(1, dtype=np.int64)
+    last = np.full(1, -1, dtype=np.int64)
+    p_b = np.zeros(1, dtype=np.float32)
+    p_nb = np.full(1, -np.inf, dtype=np.float32)
+
+    for row in data:
+        p_total = np.logaddexp(p_b, p_nb)
+        has_last = last >= 0
+
+        # staying on the same prefix: emit a blank or repeat the last char
+        stay_nb = np.where(has_last, p_nb + row[np.maximum(last, 0)], -np.inf)
+        stay_b = p_total + row[blank]
+
+        if row[blank] >= blank_skip_log_prob:
+            p_b, p_nb = stay_b, stay_nb
+            continue
 
-        # find the indexes of k largest probabilities in the row
-        k_largest = heapq.nlargest(k, range(len(row)), row.take) # -----> m
+        # find the most likely non-blank chars in this frame
+        row_nb = row.copy()
+        row_nb[blank] = -np.inf
+        candidates = np.argpartition(-row_nb, n_candidates - 1)[:n_candidates]
+        candidates = candidates[row_nb[candidates] >= prune_log_prob]
+
+        # extending a prefix with the char it ends on needs a blank in between
+        ext = p_total[:, None] + row[candidates][None, :]
+        repeat = last[:, None] == candidates[None, :]
+        ext = np.where(repeat, p_b[:, None] + row[candidates][None, :], ext)
+
+        # merge extensions that lead to a prefix already in the beam
+        beam_of_node = {node: i for i, node in enumerate(nodes.tolist())}
+        for j, node in enumerate(nodes.tolist()):
+            i = beam_of_node.get(parents[node])
+
+            if i is None:
+                continue
+
+            c = chars[node]
+            p_ext = p_b[i] + row[c] if last[i] == c else p_total[i] + row[c]
+            stay_nb[j] = np.logaddexp(stay_nb[j], p_ext)
+            ext[i, candidates == c] = -np.inf
+
+        # prefixes are ranked with their lm score
+        if fusion:
+            for node in nodes.tolist():
+                if node not in word_ends:
+                    word_ends[node] = fusion.extend(states[node], fusion.delimiter)
+
+            lm_scores = np.array([node_scores[node] for node in nodes.tolist()], dtype=np.float32)
+            word_scores = np.array([word_ends[node][1] for node in nodes.tolist()], dtype=np.float32)
+
+            fused = ext + lm_scores[:, None]
+            fused[:, candidates == fusion.delimiter] += word_scores[:, None]
+        else:
+            lm_scores = 0.0
+            fused = ext
+
+        # only the k best extensions can survive pruning
+        ext_flat = ext.ravel()
+        fused_flat = fused.ravel()
+        n_ext = min(k, ext_flat.size)
+
+        if n_ext > 0:
+            best_ext = np.argpartition(-fused_flat, n_ext - 1)[:n_ext]
+            best_ext = best_ext[fused_flat[best_ext] > -np.inf]
+        else:
+            best_ext = np.zeros(0, dtype=np.int64)
+
+        scores = np.concatenate([np.logaddexp(stay_b, stay_nb) + lm_scores, fused_flat[best_ext]])
+        keep = np.argsort(-scores, kind="stable")[:k]
+
+        new_nodes = []
+        new_last = []
+        new_p_b = []
+        new_p_nb = []
+
+        for idx in keep.tolist():
+            if idx < len(nodes):
+                new_nodes.append(nodes[idx])
+                new_last.append(last[idx])
+                new_p_b.append(stay_b[idx])
+                new_p_nb.append(stay_nb[idx])
+            else:
+                i, c = divmod(int(best_ext[idx - len(nodes)]), len(candidates))
+                c = int(candidates[c])
+                key = (int(nodes[i]), c)
+                node = children.get(key)
+
+                if node is None:
+                    node = len(parents)
+                    children[key] = node
+                    parents.append(key[0])
+                    chars.append(c)
+
+                    if fusion:
+                        state, score = word_ends[key[0]] if c == fusion.delimiter else fusion.extend(states[key[0]], c)
+                        states.append(state)
+                        node_scores.append(node_scores[key[0]] + score)
+
+                new_nodes.append(node)
+                new_last.append(c)
+                new_p_b.append(-np.inf)
+                new_p_nb.append(ext_flat[best_ext[idx - len(nodes)]])
+
+        nodes = np.array(new_nodes, dtype=np.int64)
+        last = np.array(new_last, dtype=np.int64)
+        p_b = np.array(new_p_b, dtype=np.float32)
+        p_nb = np.array(new_p_nb, dtype=np.float32)
+
+    p_total = np.logaddexp(p_b, p_nb)
+
+    if fusion:
+        p_total += np.array([node_scores[node] + fusion.finish(states[node]) for node in nodes.tolist()],
+                            dtype=np.float32)
+
+    sequences = []
+
+    for i in np.argsort(-p_total, kind="stable").tolist():
+        seq = []
+        node = nodes[i]
+
+        while node > 0:
+            seq.append(chars[node])
+            node = parents[node]
+
+        sequences.append([seq[::-1], -float(p_total[i])])
 
-        # expand each current candidate
-        for seq, score in sequences: # ----> k
-            for j in k_largest: # -----> k
-                s = score - math.log(row[j])
-                candidate = [seq + [j], s]
-                all_candidates.append(candidate)
+    return sequences
 
-        # sort all candidates by score
-        ordered = sorted(all_candidates, key=lambda tup:tup[1]) # -----> k log k
 
-        # select best k
-        sequences = ordered[:k]
+# acoustic model over a batch of segments, returns the (frames, classes) log-probs per segment
+def log_probs_batch(model, segments, sampling_rate=16000):
+    tokens = processor(segments, sampling_rate=sampling_rate, padding=True, return_attention_mask=True,
+                       return_tensors='pt').to(device)
 
-    return sequences
+    with torch.inference_mode(), stage("acoustic_model"):
+        # Store logits (non-normalized predictions)
+        logits = model(tokens.input_values, tokens.attention_mask).logits
+
+        # normalize to log-probabilities for the ctc decoder
+        log_probs = torch.nn.functional.log_softmax(logits, dim=-1).cpu().numpy()
+
+    lengths = backends.output_lengths(model.config, torch.tensor([len(seg) for seg in segments]))
 
+    return [log_probs[i, :length] for i, length in enumerate(lengths.tolist())]
 
-def predict(audio, sampling_rate=16000):
-    if len(audio) > 160_000:
-        # TODO split further
-        return '<too long segment>'
 
-    tokens = processor(audio, sampling_rate=sampling_rate, return_tensors='pt').to(device)
+# group segment indices of similar length, so padding stays small and each batch holds max_samples at most
+def length_buckets(lengths, max_samples=None):
+    if max_samples is None:
+        max_samples = max_batch_samples
 
-    # Store logits (non-normalized predictions)
-    logits = model(tokens.input_values, tokens.attention_mask).logits
+    batches = []
+    batch = []
 
-    # normalize
-    min_range = torch.min(logits)
-    max_range = torch.max(logits)
-    logits = (logits - min_range) / (max_range - min_range)
+    for i in np.argsort(lengths, kind="stable").tolist():
+        # sorted by length, so the current segment is the longest of the batch
+        if batch and (len(batch) + 1) * lengths[i] > max_samples:
+            batches.append(batch)
+            batch = []
 
-    logits = array(logits[0].cpu().detach().numpy())
+        batch.append(i)
 
-    # print(logits)
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+# run the acoustic model over overlapping windows of a long segment and stitch the frames,
+# each window contributes the frames up to the middle of its overlaps
+def windowed_log_probs(model, audio, sampling_rate=16000, max_samples=None):
+    hop = int(np.prod(model.config.conv_stride))
+    stride = window_length - window_overlap
+    half = window_overlap // 2 // hop
+
+    starts = [0]
+
+    while starts[-1] + window_length < len(audio):
+        starts.append(starts[-1] + stride)
+
+    n_frames = int(backends.output_lengths(model.config, torch.tensor(len(audio))))
+    log_probs = None
+
+    for batch in length_buckets([min(window_length, len(audio) - start) for start in starts], max_samples):
+        windows = [audio[starts[w]:starts[w] + window_length] for w in batch]
+
+        for w, window_log_probs in zip(batch, log_probs_batch(model, windows, sampling_rate)):
+            if log_probs is None:
+                log_probs = np.empty((n_frames, window_log_probs.shape[1]), dtype=np.float32)
+
+            first = 0 if w == 0 else half
+            last = len(window_log_probs) if w == len(starts) - 1 else (window_length - window_overlap // 2) // hop
+            offset = starts[w] // hop
+
+            log_probs[offset + first:offset + last] = window_log_probs[first:last]
+
+    return log_probs
+
+
+def confidence(log_probs):
+    return float(np.exp(log_probs.max(axis=1).mean())) if len(log_probs) else 1.0
+
+
+# best path decoding: the most likely char per frame, repeats collapsed and blanks removed
+def greedy_decoder(log_probs, blank=0):
+    ids = log_probs.argmax(axis=1)
+    keep = np.ones(len(ids), dtype=bool)
+    keep[1:] = ids[1:] != ids[:-1]
+
+    return ids[keep & (ids != blank)].tolist()
+
+
+def decode(log_probs, lm_mode=None, adaptive=None):
+    lm_mode = lm_mode or default_lm_mode
+    k = beam_size
+
+    if adaptive_decoding if adaptive is None else adaptive:
+        segment_confidence = confidence(log_probs)
+
+        if segment_confidence >= greedy_confidence:
+            decoded_segments.inc(path="greedy")
+
+            with stage("greedy"):
+                transcription = processor.decode(greedy_decoder(log_probs, processor.tokenizer.pad_token_id),
+                                                 group_tokens=False)
+
+            return transcription or None
+
+        k = next((width for min_confidence, width in beam_tiers if segment_confidence >= min_confidence), None)
+
+        if k is None:
+            k = beam_size
+
+    decoded_segments.inc(path=f"beam_{k}")
+
+    if lm_mode in ("ngram", "both"):
+        if fusion is None or fusion_path != ngram_path:
+            load_ngram()
+
+        # the weights are read when decoding, like the other settings in decoder_settings
+        fusion.weight = ngram_weight
+        fusion.word_bonus = word_bonus
 
     # Store predicted id's
-    # predicted_ids = torch.argmax(logits, dim=-1)
-    predicted_ids = beam_search_decoder(logits, beam_size)
+    with stage("beam_search"):
+        predicted_ids = beam_search_decoder(log_probs, k, blank=processor.tokenizer.pad_token_id,
+                                            fusion=fusion if lm_mode in ("ngram", "both") else None)
 
-    # decode the audio to generate text
-    with processor.as_target_processor():
-        scores = []
-        transcriptions = []
+    # decode the audio to generate text, the decoder already collapsed repeats
+    transcriptions = [processor.decode(predicted_id[0], group_tokens=False) for predicted_id in predicted_ids]
 
-        for predicted_id in predicted_ids:
-            transcription = processor.decode(predicted_id[0])
-            # print(transcription)
-            lm_score = lm_prob(transcription)
-            scores.append(0.5 * lm_score + 0.5 * predicted_id[1])
-            transcriptions.append(transcription)
+    # the beams come best first
+    best_idx = 0
+
+    if lm_mode in ("roberta", "both"):
+        scores = []
+        lm_scores = lm_probs(transcriptions)
 
-    best_idx = np.argmax(scores)
+        for predicted_id, lm_score in zip(predicted_ids, lm_scores):
+            scores.append(lm_weight * lm_score + am_weight * predicted_id[1])
 
-    # print("best id = ", best_idx)
+        # both scores are negative log-likelihoods, lower is better
+        best_idx = np.argmin(scores)
 
     if transcriptions[best_idx] != '':
         return transcriptions[best_idx]
 
 
-async def predict_file(filename="test_data/seq_pauze.wav"):
-    global working
+# transcribe a list of segments, labels are returned in the order of the segments
+def predict_batch(segments, sampling_rate=16000, max_samples=None, model_id=None, lm_mode=None, adaptive=None):
+    start = time.perf_counter()
+    labels = [decode(log_probs, lm_mode, adaptive)
+              for log_probs in segment_log_probs(segments, sampling_rate, max_samples, model_id)]
 
-    if working:
-        print("Waiting for other task")
-        await asyncio.sleep(5)
+    count_transcribed(segments, time.perf_counter() - start, sampling_rate)
 
-    working = True
+    return labels
 
-    if tokenizer is None:
+
+# segment and audio counters, and the real-time factor of transcribing segments in seconds
+def count_transcribed(segments, seconds, sampling_rate=16000):
+    audio_seconds = sum(len(seg) for seg in segments) / sampling_rate
+    segments_total.inc(len(segments))
+    audio_seconds_total.inc(audio_seconds)
+
+    if audio_seconds > 0:
+        real_time_factor.observe(seconds / audio_seconds)
+
+
+# acoustic model output of a list of segments, in the order of the segments
+def segment_log_probs(segments, sampling_rate=16000, max_samples=None, model_id=None):
+    if processor is None:
         init()
 
-    output = []
+    model = registry.get(model_id or default_model_id)
+
+    segments = [np.asarray(seg, dtype=np.float32) for seg in segments]
+    log_probs = [None] * len(segments)
+
+    batch_idx = []
+
+    for i, seg in enumerate(segments):
+        if len(seg) > window_length:
+            log_probs[i] = windowed_log_probs(model, seg, sampling_rate, max_samples)
+        else:
+            batch_idx.append(i)
+
+    lengths = [len(segments[i]) for i in batch_idx]
+
+    for batch in length_buckets(lengths, max_samples):
+        batch = [batch_idx[i] for i in batch]
 
-    for seg in segment(filename):
+        for i, segment_output in zip(batch, log_probs_batch(model, [segments[i] for i in batch], sampling_rate)):
+            log_probs[i] = segment_output
 
-        # print("len", len(seg))
+    return log_probs
 
-        if len(seg) < 2_048:
+
+def predict(audio, sampling_rate=16000, model_id=None, lm_mode=None, adaptive=None):
+    return predict_batch([audio], sampling_rate, model_id=model_id, lm_mode=lm_mode, adaptive=adaptive)[0]
+
+
+# (start, end, samples) of the segments of a file that are long enough to transcribe
+def load_segments(filename):
+    audio = load_audio(filename)
+    segments = []
+
+    for start, end in segment_runs(audio, segment_workers):
+
+        # print("len", end - start)
+
+        if end - start < 2_048:
             print("Too short")
             continue
 
-        torch_arr = torch.FloatTensor(seg)
-        label = predict(torch_arr)
+        segments.append((int(start), int(end), audio[start:end]))
 
-        try:
-            with NamedTemporaryFile(delete=True, suffix=".wav", mode="wb+") as f:
-                sf.write(f, seg, 16_000)
+    return segments
+
+
+# like load_segments, but segments are yielded while the file is still being segmented
+def iter_load_segments(filename):
+    for start, end, seg in iter_segments(filename):
+        if end - start < 2_048:
+            print("Too short")
+            continue
+
+        yield int(start), int(end), seg
+
+
+# how segment audio is returned: a wav or flac file, raw 16-bit little-endian samples or not at all
+audio_formats = ("wav", "flac", "pcm16", "none")
+
+
+def encode_audio(seg, audio_format="wav"):
+    with stage("encode"):
+        if audio_format == "pcm16":
+            data = (np.clip(seg, -1, 1) * 32767).astype("<i2").tobytes()
+        else:
+            with io.BytesIO() as f:
+                sf.write(f, seg, 16_000, format=audio_format.upper(), subtype="PCM_16")
+                data = f.getvalue()
+
+        return base64.b64encode(data).decode("utf-8")
+
+
+def segment_record(start, end, seg, label, audio_format="wav"):
+    record = {
+        "label": label,
+        "start": start,
+        "end": end
+    }
+
+    if audio_format != "none":
+        record["audio"] = encode_audio(seg, audio_format)
 
-                f.seek(0)
+    return record
 
-                # print(label)
 
-                output.append({
-                    "audio": base64.b64encode(f.read()).decode("utf-8"),
-                    "label": label
-                })
+# transcriptions are cached by content, uploading the same recording again returns the stored records
+async def predict_file(filename="test_data/seq_pauze.wav", model_id=None, audio_format="wav", profile=False):
+    # profile=True (or sampling, see profiling.py) writes a trace of this file
+    async with profiled_async(os.path.basename(filename), should_profile(profile)):
+        return await cached_predict_file(filename, model_id, audio_format)
+
+
+async def cached_predict_file(filename, model_id=None, audio_format="wav"):
+    digest = file_digest(filename)
+    key = settings_key(digest, decoder_settings(model_id, audio_format))
+    logits_key = settings_key(digest, acoustic_settings(model_id)) if store_logits else None
+
+    # files transcribed before the logits were stored are transcribed again
+    if logits_key is not None and logits_key not in logit_store:
+        output = await transcribe_file(filename, model_id, audio_format, logits_key)
+        transcription_cache.put(key, output)
+
+        return output
+
+    return await transcription_cache.get_or_compute(
+        key, lambda: transcribe_file(filename, model_id, audio_format))
+
+
+async def transcribe_file(filename, model_id=None, audio_format="wav", logits_key=None):
+    if processor is None:
+        init()
+
+    output = []
+    segments = load_segments(filename)
+
+    start_time = time.perf_counter()
+    log_probs = segment_log_probs([seg for _, _, seg in segments], model_id=model_id)
+    acoustic_time = time.perf_counter() - start_time
+
+    if logits_key is not None:
+        logit_store.put(logits_key, [(start, end, lp) for (start, end, _), lp in zip(segments, log_probs)], filename)
+
+    start_time = time.perf_counter()
+    labels = [decode(lp) for lp in log_probs]
+    count_transcribed([seg for _, _, seg in segments], acoustic_time + time.perf_counter() - start_time)
+
+    for (start, end, seg), label in zip(segments, labels):
+        try:
+            output.append(segment_record(start, end, seg, label, audio_format))
         except:
             print("Failed to add file")
 
-    working = False
-
     return output
 
 
-async def predict_file_async(filename="test_data/seq_pauze.wav"):
-    for seg in segment(filename):
+# newline-delimited json records, each segment is transcribed as soon as it is cut
+async def predict_file_async(filename="test_data/seq_pauze.wav", model_id=None, audio_format="wav"):
+    segments = iter_load_segments(filename)
 
-        print("len", len(seg))
+    while True:
+        timings = {}
 
-        if len(seg) < 2_048:
-            print("Too short")
-            continue
+        start_time = time.perf_counter()
+        item = next(segments, None)
+        timings["segment"] = time.perf_counter() - start_time
+        stage_seconds.observe(timings["segment"], stage="stream_segment")
+
+        if item is None:
+            break
 
-        torch_arr = torch.FloatTensor(seg)
-        label = predict(torch_arr)
+        start, end, seg = item
 
-        with NamedTemporaryFile(delete=True, suffix=".wav", mode="wb+") as f:
-            sf.write(f, seg, 16_000)
+        start_time = time.perf_counter()
+        label = predict_batch([seg], model_id=model_id)[0]
+        timings["inference"] = time.perf_counter() - start_time
 
-            f.seek(0)
+        start_time = time.perf_counter()
+        record = segment_record(start, end, seg, label, audio_format)
+        timings["encode"] = time.perf_counter() - start_time
 
-            print(label)
+        record["timings"] = timings
 
-            yield json.dumps({
-                "audio": base64.b64encode(f.read()).decode("utf-8"),
-                "label": label
-            })
+        yield json.dumps(record) + "\n"
 
 
 async def main():
@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+
+
+def model_size(model):
+    # exported models report their own size
+    if hasattr(model, "memory_size"):
+        return model.memory_size()
+
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ModelRegistry:
+    """
+    Maps model ids to checkpoint paths and loads the models on first use.
+
+    Loaded models are kept in least-recently-used order; when their total
+    size exceeds memory_budget bytes the least recently used ones are
+    dropped, the most recent model always stays loaded.
+    """
+
+    def __init__(self, load_model, paths=None, memory_budget=8 * 1024 ** 3):
+        self.load_model = load_model
+        self.paths = dict(paths or {})
+        self.memory_budget = memory_budget
+
+        self.models = OrderedDict()
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+
+    def register(self, model_id, path):
+        with self.lock:
+            self.paths[model_id] = path
+
+            # a new checkpoint for a loaded id is picked up on next use
+            if model_id in self.models:
+                self.unload(model_id)
+
+    def __contains__(self, model_id):
+        return model_id in self.paths
+
+    def loaded(self):
+        with self.lock:
+            return list(self.models)
+
+    def get(self, model_id):
+        with self.lock:
+            if model_id in self.models:
+                self.models.move_to_end(model_id)
+                return self.models[model_id]
+
+            if model_id not in self.paths:
+                raise KeyError(f"Unknown model: {model_id}")
+
+            path = self.paths[model_id]
+
+        # loading takes long, only one model is loaded at a time and other ids stay available
+        with self.load_lock:
+            with self.lock:
+                if model_id in self.models:
+                    self.models.move_to_end(model_id)
+                    return self.models[model_id]
+
+            print("Loading am", model_id)
+            model = self.load_model(path)
+
+            with self.lock:
+                self.models[model_id] = model
+                self.sizes[model_id] = model_size(model)
+                self.evict()
+
+        return model
+
+    def evict(self):
+        while len(self.models) > 1 and sum(self.sizes.values()) > self.memory_budget:
+            model_id = next(iter(self.models))
+            print("Unloading am", model_id)
+            self.unload(model_id)
+
+    def unload(self, model_id):
+        del self.models[model_id]
+        del self.sizes[model_id]
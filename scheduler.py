@@ -0,0 +1,141 @@
+import asyncio
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from queue import PriorityQueue, Empty
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Inference queue is full")
+        self.retry_after = retry_after
+
+
+class Scheduler:
+    """
+    Runs segments from all requests on one inference worker thread.
+
+    Segments wait in a priority queue ordered by the total audio length of
+    their request, so short clips overtake long interviews. The worker takes
+    the first waiting segment, keeps collecting for at most max_wait seconds
+    or until max_batch_size segments are gathered, and transcribes them as
+    one batch with predict_batch.
+
+    Admission is limited twice: at most max_queue requests hold a slot, and
+    transcribe() rejects a request whose segments would take the queue past
+    max_segments (unless the queue is empty, so a single recording longer
+    than that still runs). Streaming requests submit a few segments at a
+    time and are only limited by their slot.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=16, max_wait=0.05, max_queue=32, retry_after=10,
+                 max_segments=1024):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.max_segments = max_segments
+
+        self.queue = PriorityQueue()
+        self.counter = itertools.count()
+        self.active = 0
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def start(self):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run, name="inference-worker", daemon=True)
+            self.worker.start()
+
+    # admission control, a request holds a slot from upload until its last segment is done
+    def acquire(self):
+        with self.lock:
+            if self.active >= self.max_queue:
+                raise QueueFullError(self.retry_after)
+
+            self.active += 1
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+
+        try:
+            yield
+        finally:
+            self.release()
+
+    # priority defaults to the total audio length of the segments, lower goes first
+    def submit(self, segments, model_id=None, priority=None):
+        if priority is None:
+            priority = sum(len(seg) for seg in segments)
+
+        request_id = next(self.counter)
+        futures = []
+
+        for i, seg in enumerate(segments):
+            future = Future()
+            futures.append(future)
+            self.queue.put((priority, request_id, i, seg, model_id, future))
+
+        return futures
+
+    async def transcribe(self, segments, model_id=None):
+        queued = self.queue.qsize()
+
+        if queued and queued + len(segments) > self.max_segments:
+            raise QueueFullError(self.retry_after)
+
+        futures = self.submit(segments, model_id)
+
+        try:
+            return await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Empty:
+                break
+
+        # segments of abandoned requests are skipped
+        return [item for item in batch if item[5].set_running_or_notify_cancel()]
+
+    def run(self):
+        while True:
+            batches = {}
+
+            # only segments for the same acoustic model can share a forward pass
+            for item in self.next_batch():
+                batches.setdefault(item[4], []).append(item)
+
+            for model_id, batch in batches.items():
+                self.run_batch(model_id, batch)
+
+    def run_batch(self, model_id, batch):
+        try:
+            labels = self.predict_batch([item[3] for item in batch], model_id=model_id)
+        except Exception as e:
+            for item in batch:
+                item[5].set_exception(e)
+            return
+
+        for item, label in zip(batch, labels):
+            item[5].set_result(label)
@@ -0,0 +1,144 @@
+"""
+Serves app.py from several worker processes that share one copy of the
+model weights:
+
+    python serve.py --workers 4 --port 8000
+
+The parent loads the processor, the default acoustic model and the lm,
+binds the socket and forks the workers. The forked workers share the
+weights' memory pages copy-on-write (inference never writes to them), so
+every extra worker costs its activations and caches, not another copy of
+the models. The parent stays as a supervisor that forks a new worker
+whenever one dies and stops them all on SIGTERM or SIGINT.
+
+Each worker has its own scheduler, lm cache and metrics; /metrics shows
+the worker that answered.
+"""
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import uvicorn
+
+import app
+import recognize
+
+# workers dying within this many seconds of their start count as a crash loop and are restarted with a delay
+min_uptime = 10
+restart_delay = 5
+
+
+def bind(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    return sock
+
+
+def run_worker(sock, torch_threads):
+    # the supervisor's handlers are not for the workers, uvicorn installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    # the threads are set on startup, before the first forward pass of this process
+    app.torch_threads = torch_threads
+
+    server = uvicorn.Server(uvicorn.Config(app.app, log_level="info"))
+    server.run(sockets=[sock])
+
+
+def spawn(sock, torch_threads):
+    pid = os.fork()
+
+    if pid == 0:
+        code = 0
+
+        try:
+            run_worker(sock, torch_threads)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+
+        # never return into the supervisor's code
+        os._exit(code)
+
+    print("Started worker", pid)
+
+    return pid
+
+
+def supervise(sock, workers, torch_threads):
+    stopping = False
+    started = {}
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+        for pid in started:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        started[spawn(sock, torch_threads)] = time.monotonic()
+
+    while started:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+
+        uptime = time.monotonic() - started.pop(pid)
+
+        if stopping:
+            continue
+
+        print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)} after {uptime:.0f}s")
+
+        if uptime < min_uptime:
+            time.sleep(restart_delay)
+
+        if not stopping:
+            started[spawn(sock, torch_threads)] = time.monotonic()
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+
+    parser = argparse.ArgumentParser(description="Serve app.py from several processes")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=max(1, cpu_count // 4))
+    parser.add_argument("--torch-threads", type=int, help="torch threads per worker (default: the cores "
+                                                          "left after the io threads, divided over the workers)")
+    args = parser.parse_args()
+
+    torch_threads = args.torch_threads or max(1, (cpu_count - args.workers * app.io_workers) // args.workers)
+
+    # everything is loaded before the fork, so the workers share it
+    recognize.init()
+
+    # objects from before the fork are never collected, so the collector does not touch (and copy) their pages
+    gc.freeze()
+
+    sock = bind(args.host, args.port)
+    print(f"Serving on {args.host}:{args.port} with {args.workers} workers of {torch_threads} torch threads")
+
+    supervise(sock, args.workers, torch_threads)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
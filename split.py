@@ -1,9 +1,18 @@
-from pathlib import Path
-from tempfile import NamedTemporaryFile
+import multiprocessing
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
 
 import numpy as np
-from pydub import AudioSegment
-import librosa
+import soundfile as sf
+import soxr
+
+from profiling import stage
+
+SAMPLE_RATE = 16_000
+MPEG_FRAME = 1_152
 
 MAX_LENGTH = 160_000
 OPT_LENGTH = 30_000
@@ -17,82 +26,567 @@ MIN_HOP = 64
 SEQ_LENGTH = 8_192
 MIN_SEQ_LENGTH = 2_048
 
+# frames per block of the energy pass
+ENERGY_BLOCK = 65_536
 
-def segment(filename="test_data/seq_pauze.mp3"):
-    suffix = Path(filename).suffix
+# streaming segmentation
+BLOCK_SIZE = 160_000
+LOOKAHEAD = 4 * MAX_LENGTH
+AMIN = 1e-10
 
-    if suffix == ".mp3":
-        with NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp_path = Path(tmp.name)
 
-            # convert wav to mp3
-            aud_seg = AudioSegment.from_mp3(filename)
-            aud_seg.export(tmp_path, format="wav")
+# the blocks of iter_audio are copied into one array sized from the file's header, so the
+# recording is held once (a list of blocks and their concatenation would hold it twice)
+def load_audio(filename):
+    with stage("load_audio"):
+        audio = np.empty(expected_length(filename), dtype=np.float32)
+        length = 0
 
-            audio, _ = librosa.load(tmp_path, sr=16000)
-    else:
-        audio, _ = librosa.load(filename, sr=16000)
+        for block in iter_audio(filename):
+            if length + len(block) > len(audio):
+                grown = np.empty(max(2 * len(audio), length + len(block)), dtype=np.float32)
+                grown[:length] = audio[:length]
+                audio = grown
 
-    return segment_wave(audio)
+            audio[length:length + len(block)] = block
+            length += len(block)
 
+        # a few samples of resampler slack are not worth a copy
+        if len(audio) - length > BLOCK_SIZE:
+            return audio[:length].copy()
 
-def segment_wave(audio):
-    runs = librosa.effects.split(audio, top_db=50, frame_length=MIN_SEQ_LENGTH, hop_length=MIN_HOP)
-    runs = list(runs)
+        return audio[:length]
 
-    while True:
-        if np.all([x[1] - x[0] > OPT_LENGTH for x in runs]):
-            break
 
-        silences = [b[0] - a[1] for a, b in zip(runs[:-1], runs[1:])]
-        shortest_silence_idx = np.argsort(silences)
+# samples of a file at SAMPLE_RATE according to its header, 0 when libsndfile can not read it
+def expected_length(filename):
+    try:
+        info = sf.info(filename)
+    except RuntimeError:
+        return 0
+
+    return -(-info.frames * SAMPLE_RATE // info.samplerate) + 1
+
+
+# 16 kHz mono audio of a file in blocks of about block_size samples, decoded and resampled
+# incrementally so the file is never held in memory as a whole
+def iter_audio(filename, block_size=BLOCK_SIZE):
+    try:
+        f = sf.SoundFile(filename)
+    except RuntimeError:
+        # formats libsndfile can not read are decoded by ffmpeg
+        yield from iter_audio_ffmpeg(filename, block_size)
+        return
+
+    with f:
+        resampler = None
+
+        if f.samplerate != SAMPLE_RATE:
+            resampler = soxr.ResampleStream(f.samplerate, SAMPLE_RATE, 1, dtype="float32")
+
+        # libsndfile's mp3 decoder only reads cleanly in whole mpeg frames of 1152 samples
+        frames = max(1, block_size * f.samplerate // SAMPLE_RATE // MPEG_FRAME)
 
-        success = False
-        for silence_idx in shortest_silence_idx:
-            a = runs[silence_idx]
-            b = runs[silence_idx + 1]
+        for block in f.blocks(blocksize=frames * MPEG_FRAME, dtype="float32", always_2d=True):
+            block = block.mean(axis=1)
 
-            if b[1] - a[0] < MAX_LENGTH:
-                runs[silence_idx][1] = runs[silence_idx + 1][1]
-                del runs[silence_idx + 1]
-                success = True
+            if resampler is not None:
+                block = resampler.resample_chunk(block)
+
+            if len(block):
+                yield block
+
+        if resampler is not None:
+            block = resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+            if len(block):
+                yield block
+
+
+def iter_audio_ffmpeg(filename, block_size=BLOCK_SIZE):
+    command = ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", str(filename),
+               "-f", "f32le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-"]
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+    try:
+        while True:
+            data = process.stdout.read(block_size * 4)
+
+            if not data:
                 break
 
-        if not success:
-            print("not optimal")
-            break
+            yield np.frombuffer(data[:len(data) // 4 * 4], dtype="<f4")
 
-    chunks = []
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg could not decode {filename}")
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+
+def segment(filename="test_data/seq_pauze.mp3", workers=1):
+    return segment_wave(load_audio(filename), workers)
+
+
+def segment_wave(audio, workers=1):
+    return [audio[start:end] for start, end in segment_runs(audio, workers)]
+
+
+# (start, end) sample offsets of the segments of audio, with workers > 1 the energy pass and the
+# recursive splitting of long runs are spread over a process pool with identical results
+def segment_runs(audio, workers=1):
+    if len(audio) == 0:
+        return []
+
+    with stage("segment"):
+        if workers > 1:
+            return segment_runs_parallel(audio, workers)
+
+        power = np.concatenate([block_power(audio, first, last) for first, last in energy_blocks(len(audio))])
+        runs = merge_runs(power_to_runs(power, 50, MIN_HOP, len(audio)))
+
+        return split_long_runs(audio, runs)
+
+
+def segment_runs_parallel(audio, workers):
+    audio = np.asarray(audio, dtype=np.float32)
+    memory = shared_memory.SharedMemory(create=True, size=max(1, audio.nbytes))
+    pool = segment_pool(workers)
+
+    try:
+        np.ndarray(audio.shape, dtype=np.float32, buffer=memory.buf)[:] = audio
+        shared = (memory.name, len(audio))
+
+        # blocks are concatenated in order, runs crossing a block boundary are stitched by
+        # power_to_runs as if the power was computed in one pass
+        blocks = energy_blocks(len(audio))
+        power = np.concatenate(list(pool.map(shared_block_power, [shared] * len(blocks), blocks)))
+        runs = merge_runs(power_to_runs(power, 50, MIN_HOP, len(audio)))
+
+        long_runs = [run for run in runs if run[1] - run[0] > MAX_LENGTH]
+        long_spans = dict(zip(map(tuple, long_runs), pool.map(shared_long_run_spans, [shared] * len(long_runs),
+                                                               long_runs)))
+    except BrokenProcessPool:
+        discard_pool(pool)
+        raise
+    finally:
+        memory.close()
+        memory.unlink()
+
+    spans = []
 
     for run in runs:
-        seg = audio[run[0]:run[1]]
+        spans.extend(long_spans.get(tuple(run), [(run[0], run[1])]))
+
+    return spans
+
+
+# frame ranges of the energy pass, a fixed grid so every block is computed the same way
+# whether it runs serially or in a worker
+def energy_blocks(length, frame_length=MIN_SEQ_LENGTH, hop_length=MIN_HOP):
+    n_frames = 1 + (length + 2 * (frame_length // 2) - frame_length) // hop_length
+
+    return [(first, min(first + ENERGY_BLOCK, n_frames)) for first in range(0, n_frames, ENERGY_BLOCK)]
+
+
+# mean power of the centered, zero padded frames first to last of audio, like librosa.feature.rms ** 2
+def block_power(audio, first, last, frame_length=MIN_SEQ_LENGTH, hop_length=MIN_HOP):
+    frame_start = np.arange(first, last) * hop_length - frame_length // 2
+
+    lo = np.clip(frame_start, 0, len(audio))
+    hi = np.clip(frame_start + frame_length, 0, len(audio))
+
+    cumsum = np.concatenate([[0], np.cumsum(np.square(audio[lo[0]:hi[-1]], dtype=np.float64))])
+
+    return (cumsum[hi - lo[0]] - cumsum[lo - lo[0]]) / frame_length
+
+
+# one pool for all files, started lazily. Its workers come from a fork server (or are spawned where
+# there is none), never forked from a process with inference threads running, so scripts using
+# workers > 1 need the if __name__ == "__main__" guard
+pool = None
+pool_workers = 0
+pool_lock = threading.Lock()
+
+
+def segment_pool(workers):
+    global pool
+    global pool_workers
+
+    with pool_lock:
+        if pool is None or pool_workers != workers:
+            if pool is not None:
+                pool.shutdown(wait=False)
+
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            pool = ProcessPoolExecutor(workers, mp_context=context)
+            pool_workers = workers
+
+        return pool
+
+
+# a pool that lost a worker can not be used again, the next file starts a new one
+def discard_pool(broken):
+    global pool
+
+    with pool_lock:
+        if pool is broken:
+            pool = None
+
+    broken.shutdown(wait=False)
+
+
+# the worker functions attach to the audio of the current file for one block or run
+def shared_block_power(shared, block):
+    return with_shared_audio(shared, block_power, *block)
+
+
+def shared_long_run_spans(shared, run):
+    return with_shared_audio(shared, long_run_spans, run)
+
+
+def with_shared_audio(shared, fn, *args):
+    name, length = shared
+    memory = shared_memory.SharedMemory(name=name)
+
+    try:
+        return fn(np.ndarray((length,), dtype=np.float32, buffer=memory.buf), *args)
+    finally:
+        try:
+            memory.close()
+        except BufferError:
+            # a traceback still holds the array, the mapping goes with it
+            pass
+
+
+# merge neighbouring runs over the shortest silences until all are longer than OPT_LENGTH
+#
+# a silence keeps its length when runs merge, and a silence too long to merge stays too long
+# because its neighbours only grow, so one pass over the silences ordered by length (ties left
+# to right) picks the same merges as repeatedly searching for the shortest mergeable silence
+def merge_runs(runs):
+    runs = np.asarray(runs, dtype=np.int64).reshape(-1, 2)
+
+    starts = runs[:, 0].tolist()
+    ends = runs[:, 1].tolist()
+    short = int(np.count_nonzero(runs[:, 1] - runs[:, 0] <= OPT_LENGTH))
+
+    # runs form a linked list, a merged run lives on at its left index
+    left = list(range(-1, len(runs) - 1))
+    right = list(range(1, len(runs) + 1))
+    alive = np.ones(len(runs), dtype=bool)
+
+    # silences by the index of the run on their right
+    silences = runs[1:, 0] - runs[:-1, 1]
+
+    for b in (np.argsort(silences, kind="stable") + 1).tolist():
+        if short == 0:
+            break
+
+        a = left[b]
+
+        if ends[b] - starts[a] < MAX_LENGTH:
+            short -= (ends[a] - starts[a] <= OPT_LENGTH) + (ends[b] - starts[b] <= OPT_LENGTH)
+            ends[a] = ends[b]
+            short += ends[a] - starts[a] <= OPT_LENGTH
+
+            right[a] = right[b]
+
+            if right[b] < len(runs):
+                left[right[b]] = a
+
+            alive[b] = False
+    else:
+        if short:
+            print("not optimal")
+
+    return [[starts[i], ends[i]] for i in np.flatnonzero(alive).tolist()]
 
+
+# runs longer than MAX_LENGTH are split further on quieter pauses, offset is the position of audio[0]
+def split_long_runs(audio, runs, offset=0):
+    spans = []
+
+    for run in runs:
         if run[1] - run[0] > MAX_LENGTH:
-            chunks.append(segment_wave_recursive(seg, frame_length=SEQ_LENGTH, hop_length=START_HOP_LENGTH))
+            spans.extend(long_run_spans(audio, run, offset))
         else:
-            chunks.append(seg)
+            spans.append((run[0], run[1]))
+
+    return spans
+
 
-    return chunks
+def long_run_spans(audio, run, offset=0):
+    seg = audio[run[0] - offset:run[1] - offset]
+
+    return shift(segment_runs_recursive(seg, frame_length=SEQ_LENGTH, hop_length=START_HOP_LENGTH), run[0])
+
+
+def shift(spans, offset):
+    return [(start + offset, end + offset) for start, end in spans]
 
 
 def segment_wave_recursive(audio, frame_length=SEQ_LENGTH, hop_length=START_HOP_LENGTH):
-    runs = librosa.effects.split(audio, top_db=30, frame_length=frame_length, hop_length=hop_length)
+    return [audio[start:end] for start, end in segment_runs_recursive(audio, frame_length, hop_length)]
 
-    chunks = []
 
-    for run in runs:
-        split = audio[run[0]:run[1]]
+def segment_runs_recursive(audio, frame_length=SEQ_LENGTH, hop_length=START_HOP_LENGTH):
+    return split_recursive(EnergyIndex(audio), 0, len(audio), frame_length, hop_length)
+
 
+# every recursion level queries the same energy index instead of re-framing the audio
+def split_recursive(index, start, end, frame_length, hop_length):
+    runs = index.split(start, end, top_db=30, frame_length=frame_length, hop_length=hop_length) + start
+
+    spans = []
+
+    for run in runs:
         if run[1] - run[0] < MAX_LENGTH or (hop_length <= MIN_HOP and frame_length <= MIN_SEQ_LENGTH):
             if frame_length >= MIN_SEQ_LENGTH:
-                chunks.append(split)
+                spans.append((run[0], run[1]))
         elif frame_length > MIN_SEQ_LENGTH and hop_length <= MIN_HOP:
 
-            chunks.extend(segment_wave_recursive(split, int(frame_length * FRAME_LENGTH_DECAY), MIN_HOP))
+            spans.extend(split_recursive(index, run[0], run[1], int(frame_length * FRAME_LENGTH_DECAY), MIN_HOP))
         else:
-            chunks.extend(segment_wave_recursive(split, frame_length, int(hop_length * HOP_LENGTH_DECAY)))
+            spans.extend(split_recursive(index, run[0], run[1], frame_length, int(hop_length * HOP_LENGTH_DECAY)))
+
+    return spans
+
+
+class EnergyIndex:
+    """
+    Cumulative sum of the squared samples of audio, built once.
+
+    The mean power of any frame of any sub-array is the difference of two
+    entries, so librosa.effects.split can be repeated at every frame and hop
+    length of the recursion in O(1) per frame. Boundaries match librosa's
+    except where a frame's power lies within float32 rounding (about 1e-6
+    relative) of the threshold, which moves that boundary by one hop.
+    """
+
+    def __init__(self, audio, block_size=1_048_576):
+        self.cumsum = np.zeros(len(audio) + 1)
+
+        # summed block by block into one array, without full size temporaries
+        for start in range(0, len(audio), block_size):
+            block = np.square(audio[start:start + block_size], dtype=np.float64)
+            block[0] += self.cumsum[start]
+            np.cumsum(block, out=self.cumsum[start + 1:start + 1 + len(block)])
+
+    # mean power of the centered, zero padded frames of audio[start:end], like librosa.feature.rms ** 2
+    def frame_power(self, start, end, frame_length, hop_length):
+        length = end - start
+        n_frames = 1 + (length + 2 * (frame_length // 2) - frame_length) // hop_length
+        frame_start = np.arange(n_frames) * hop_length - frame_length // 2
+
+        lo = np.clip(frame_start, 0, length) + start
+        hi = np.clip(frame_start + frame_length, 0, length) + start
+
+        return (self.cumsum[hi] - self.cumsum[lo]) / frame_length
+
+    # librosa.effects.split on audio[start:end] with ref=np.max, runs are relative to start
+    def split(self, start, end, top_db=60, frame_length=2048, hop_length=512):
+        power = self.frame_power(start, end, frame_length, hop_length)
+
+        return power_to_runs(power, top_db, hop_length, end - start)
+
+
+def power_to_runs(power, top_db, hop_length, length):
+    ref = max(AMIN, power.max(initial=0))
+    non_silent = 10 * np.log10(np.maximum(AMIN, power) / ref) > -top_db
+
+    edges = [np.flatnonzero(np.diff(non_silent.astype(int))) + 1]
+
+    if len(non_silent) and non_silent[0]:
+        edges.insert(0, [0])
+
+    if len(non_silent) and non_silent[-1]:
+        edges.append([len(non_silent)])
+
+    edges = np.minimum(np.concatenate(edges).astype(np.int64) * hop_length, length)
+
+    return edges.reshape((-1, 2))
+
+
+# (start, end, samples) of the segments of a file, as soon as their boundaries are final
+def iter_segments(filename, block_size=BLOCK_SIZE):
+    # audio that never gets 50 dB below its loudest frame is one run, it is closed every LOOKAHEAD
+    # samples so it is split further by split_long_runs instead of waiting for the end of the file
+    segmenter = StreamingSegmenter(max_run_length=LOOKAHEAD)
+
+    for block in iter_audio(filename, block_size):
+        yield from segmenter.push(block)
+
+    yield from segmenter.flush()
+
+
+class StreamingSegmenter:
+    """
+    Incremental version of segment_runs for audio that arrives in blocks.
+
+    Frames are compared to the loudest frame seen so far rather than the
+    loudest frame of the whole file, and runs are merged within a window of
+    lookahead samples: once the pending runs (the open one included) span
+    that much audio, all merged runs but the last are final. Apart from that
+    the segments match segment_runs.
+
+    max_run_length closes runs that go on for longer at their quietest frame
+    in the second half, so latency and memory stay bounded. For live audio,
+    close_after makes the pending runs final after that many samples of
+    silence.
+    """
+
+    def __init__(self, top_db=50, frame_length=MIN_SEQ_LENGTH, hop_length=MIN_HOP, lookahead=LOOKAHEAD,
+                 close_after=None, max_run_length=None):
+        self.top_db = top_db
+        self.frame_length = frame_length
+        self.hop_length = hop_length
+        self.lookahead = lookahead
+        self.close_after = close_after
+        self.max_run_length = max_run_length
+
+        # audio from sample self.offset on, older samples are no longer needed; energy[i] is the
+        # sum of the squares of audio[:i], kept up to date block by block
+        self.audio = np.zeros(0, dtype=np.float32)
+        self.energy = np.zeros(1)
+        self.offset = 0
+        self.n_samples = 0
+
+        self.n_frames = 0
+        self.ref = AMIN
+        self.run_start = None
+        self.runs = []
+
+    def push(self, block):
+        block = np.asarray(block, dtype=np.float32)
+
+        self.audio = np.concatenate([self.audio, block])
+        self.energy = np.concatenate([self.energy, self.energy[-1] + np.cumsum(np.square(block, dtype=np.float64))])
+        self.n_samples += len(block)
+
+        # frames are centered on frame * hop_length, a frame is complete once its second half has arrived
+        n_frames = max(0, (self.n_samples - self.frame_length // 2) // self.hop_length + 1)
+        self.classify(n_frames)
+
+        return self.emit(final=False)
+
+    def flush(self):
+        self.classify(1 + self.n_samples // self.hop_length)
+
+        if self.run_start is not None:
+            self.runs.append([self.run_start * self.hop_length, self.n_samples])
+            self.run_start = None
+
+        return self.emit(final=True)
+
+    # mean power of the frames first to last, from the energy of the samples still kept
+    def frame_power(self, first, last):
+        frames = np.arange(first, last)
+        lo = np.clip(frames * self.hop_length - self.frame_length // 2, self.offset, self.n_samples) - self.offset
+        hi = np.clip(frames * self.hop_length + self.frame_length // 2, self.offset, self.n_samples) - self.offset
+
+        return (self.energy[hi] - self.energy[lo]) / self.frame_length
+
+    def classify(self, n_frames):
+        if n_frames <= self.n_frames:
+            return
+
+        power = self.frame_power(self.n_frames, n_frames)
+
+        self.ref = max(self.ref, power.max())
+        non_silent = 10 * np.log10(np.maximum(AMIN, power) / self.ref) > -self.top_db
+
+        # frames where a run starts or stops
+        changes = np.flatnonzero(np.diff(np.concatenate([[self.run_start is not None], non_silent])))
+
+        for i in changes.tolist():
+            frame = self.n_frames + i
+
+            if self.run_start is None:
+                self.run_start = frame
+            else:
+                self.runs.append([self.run_start * self.hop_length, min(frame * self.hop_length, self.n_samples)])
+                self.run_start = None
+
+        self.n_frames = n_frames
+
+        if self.max_run_length is not None and self.run_start is not None and \
+                (self.n_frames - self.run_start) * self.hop_length >= self.max_run_length:
+            # cut where it is quietest, not in the middle of a word
+            first = self.run_start + (self.n_frames - self.run_start) // 2
+            cut = first + int(np.argmin(self.frame_power(first, self.n_frames)))
+
+            self.runs.append([self.run_start * self.hop_length, cut * self.hop_length])
+            self.run_start = cut
+
+    # end of the pending audio, the open run included
+    def pending_end(self):
+        if self.run_start is not None:
+            return self.n_frames * self.hop_length
+
+        return self.runs[-1][1]
+
+    def emit(self, final):
+        if not self.runs:
+            spans = []
+        elif final:
+            spans = merge_runs(self.runs)
+            self.runs = []
+        elif self.close_after is not None and self.run_start is None and \
+                self.n_frames * self.hop_length - self.runs[-1][1] >= self.close_after:
+            spans = merge_runs(self.runs)
+            self.runs = []
+        elif self.pending_end() - self.runs[0][0] >= self.lookahead:
+            spans = merge_runs(self.runs)
+
+            # the last run can still merge with the runs after it, unless it is too long to
+            if spans[-1][1] - spans[-1][0] < MAX_LENGTH:
+                self.runs = spans[-1:]
+                spans = spans[:-1]
+            else:
+                self.runs = []
+        else:
+            spans = []
+
+        segments = [(start, end, self.audio[start - self.offset:end - self.offset].copy())
+                    for start, end in split_long_runs(self.audio, spans, self.offset)]
+
+        self.trim()
+
+        return segments
+
+    # (start, end, samples) of the audio that is not part of a final segment yet, None during silence
+    def pending(self):
+        starts = [run[0] for run in self.runs[:1]]
+
+        if self.run_start is not None:
+            starts.append(self.run_start * self.hop_length)
+
+        if not starts:
+            return None
+
+        start = min(starts)
+
+        return start, self.n_samples, self.audio[start - self.offset:].copy()
+
+    # drop audio before the pending runs and the next frame
+    def trim(self):
+        keep = self.n_frames * self.hop_length - self.frame_length // 2
+
+        if self.runs:
+            keep = min(keep, self.runs[0][0])
+
+        if self.run_start is not None:
+            keep = min(keep, self.run_start * self.hop_length)
+
+        keep = max(keep, self.offset)
 
-    return chunks
+        self.audio = self.audio[keep - self.offset:]
+        self.energy = self.energy[keep - self.offset:] - self.energy[keep - self.offset]
+        self.offset = keep
 
 
 if __name__ == "__main__":
@@ -0,0 +1,25 @@
+import pytest
+
+pytest.importorskip("transformers")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+import export
+import recognize
+from benchmark import models
+from benchmark.backends import parity
+
+
+# the tiny random benchmark model exported to torchscript and onnx, both match eager pytorch
+def test_exported_backends_match_eager(tmp_path, monkeypatch):
+    models.build(str(tmp_path))
+    checkpoint = str(tmp_path / "am")
+    output = export.export(checkpoint, str(tmp_path / "exported"))
+
+    monkeypatch.setattr(recognize, "tokenizer_name", str(tmp_path / "processor"))
+    monkeypatch.setattr(recognize, "processor", recognize.load_processor())
+    monkeypatch.setattr(recognize, "backend", "eager")
+
+    paths = {"eager": checkpoint, "torchscript": output, "onnx": output}
+
+    assert parity(paths, [2_048, 16_000, 48_000, 160_000], tolerance=1e-3)
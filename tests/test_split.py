@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from benchmark.audio import utterances
+from split import merge_runs, segment_runs, MAX_LENGTH, OPT_LENGTH
+
+
+# merge_runs before it became one pass over the sorted silences, with a stable sort
+def merge_runs_loop(runs):
+    runs = [list(run) for run in runs]
+
+    while True:
+        if np.all([x[1] - x[0] > OPT_LENGTH for x in runs]):
+            break
+
+        silences = [b[0] - a[1] for a, b in zip(runs[:-1], runs[1:])]
+        shortest_silence_idx = np.argsort(silences, kind="stable")
+
+        success = False
+        for silence_idx in shortest_silence_idx:
+            a = runs[silence_idx]
+            b = runs[silence_idx + 1]
+
+            if b[1] - a[0] < MAX_LENGTH:
+                runs[silence_idx][1] = runs[silence_idx + 1][1]
+                del runs[silence_idx + 1]
+                success = True
+                break
+
+        if not success:
+            break
+
+    return runs
+
+
+# runs with many equally long silences, so the order of ties matters
+def random_runs(rng, n):
+    lengths = rng.integers(1_000, 2 * OPT_LENGTH, size=n)
+    silences = rng.choice([64, 128, 512, 2_048, 16_000, MAX_LENGTH], size=n)
+
+    starts = np.cumsum(silences + np.concatenate([[0], lengths[:-1]]))
+
+    return np.stack([starts, starts + lengths], axis=1).tolist()
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_merge_runs_matches_loop(seed):
+    rng = np.random.default_rng(seed)
+    runs = random_runs(rng, int(rng.integers(1, 80)))
+
+    assert merge_runs(runs) == merge_runs_loop(runs)
+
+
+def test_merge_runs_keeps_long_runs():
+    runs = [[0, OPT_LENGTH + 1], [OPT_LENGTH + 100, 2 * OPT_LENGTH + 200]]
+
+    assert merge_runs(runs) == runs
+
+
+# speech whose pauses stay within 50 dB, with every silent_every-th pause made silent: several runs,
+# the longer ones are split by the recursion
+def speech(seconds, seed, silent_every=None):
+    pieces = list(utterances(seconds, seed))
+
+    if silent_every:
+        pieces = [np.zeros_like(piece) if i % (2 * silent_every) == 1 else piece for i, piece in enumerate(pieces)]
+
+    return np.concatenate(pieces)
+
+
+@pytest.mark.parametrize("silent_every", [None, 5])
+def test_segment_runs_parallel_matches_serial(silent_every):
+    audio = speech(300, 1, silent_every)
+
+    serial = [tuple(map(int, span)) for span in segment_runs(audio, 1)]
+    parallel = [tuple(map(int, span)) for span in segment_runs(audio, 2)]
+
+    assert parallel == serial
+    assert len(serial) > 10